@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+2D MOVING BLOBS WITH MPI
+
+Distributed memory version of the shifted POD. Every rank only sets up its rows of the
+snapshot matrix and of the transformations. Run with:
+
+    mpirun -n 4 python 04_mpi_moving_blobs_2D.py
+
+With the option --check the result is compared to the serial shifted_POD on rank 0.
+"""
+
+###############################################################################
+# IMPORTED MODULES
+###############################################################################
+import sys
+sys.path.append('../lib')
+import numpy as np
+from numpy import exp, mod, meshgrid, pi, sin, cos
+from mpi4py import MPI
+from sPOD_mpi import shifted_POD_mpi, distributed_transforms, row_partition
+###############################################################################
+comm = MPI.COMM_WORLD
+##########################################
+#%% Define your DATA:
+##########################################
+Ngrid = [128, 64]   # number of grid points in x and y
+Nt = 40             # Number of time intervalls
+Nvar = 1            # Number of variables
+nmodes = [2, 2]     # number of modes in every frame
+Niter = 200         # number of sPOD iterations
+
+data_shape = [*Ngrid, Nvar, Nt]
+T = 2*pi                  # total time
+L = np.asarray([2, 1])    # total domain size
+x, y = (np.arange(Ngrid[i])*L[i]/Ngrid[i] for i in range(2))
+time = np.linspace(0, T, Nt)
+dx, dy = (x[1]-x[0], y[1]-y[0])
+width = 0.05*min(L)
+
+shift1 = np.stack([0.3*L[0]*sin(time), np.zeros(Nt)])
+shift2 = np.stack([np.zeros(Nt), -0.3*L[1]*cos(time)])
+center1 = (0.3*L[0], 0.5*L[1])
+center2 = (0.7*L[0], 0.5*L[1])
+
+# every rank only computes its rows of the snapshot matrix (lexicographic order ix*Ny + iy)
+rows = row_partition(np.prod(data_shape[:3]), comm)
+ix, iy = np.unravel_index(np.arange(rows.start, rows.stop), Ngrid)
+X, Y = x[ix, None], y[iy, None]
+blob = lambda x0, y0: exp(-((mod(X - x0 + L[0]/2, L[0]) - L[0]/2)**2 +
+                             (mod(Y - y0 + L[1]/2, L[1]) - L[1]/2)**2)/width**2)
+q_local = blob(center1[0] - shift1[0], center1[1] - shift1[1]) \
+        + blob(center2[0] - shift2[0], center2[1] - shift2[1]) * cos(time)
+
+#######################################
+# %% CALL THE SPOD algorithm
+######################################
+trafos = [distributed_transforms(data_shape, L, shifts=shift, dx=[dx, dy], rows=rows, comm=comm)
+          for shift in [shift1, shift2]]
+ret = shifted_POD_mpi(q_local, trafos, nmodes, eps=1e-4, Niter=Niter, comm=comm)
+if comm.rank == 0:
+    print("ranks: %d  iterations: %d  rel_err: %4.4e" % (comm.size, len(ret.rel_err_hist), ret.rel_err_hist[-1]))
+
+###########################################
+# %% compare to the serial sPOD
+##########################################
+if "--check" in sys.argv:
+    from sPOD_tools import shifted_POD
+    from transforms import transforms
+    q_list = comm.gather(q_local, root=0)
+    qtilde_list = comm.gather(ret.data_approx, root=0)
+    if comm.rank == 0:
+        q = np.concatenate(q_list, axis=0)
+        qtilde = np.concatenate(qtilde_list, axis=0)
+        trafos_serial = [transforms(data_shape, L, shifts=shift, dx=[dx, dy]) for shift in [shift1, shift2]]
+        ret_serial = shifted_POD(q, trafos_serial, nmodes, eps=1e-4, Niter=Niter)
+        print("max difference to serial shifted_POD: %4.4e" % np.max(np.abs(qtilde - ret_serial.data_approx)))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Distributed memory version of the shifted POD.
+
+The snapshot matrix is partitioned in rows (space) across the MPI ranks. Every rank
+keeps only its rows of the snapshots, the frames and the transformations. The transformations
+exchange the halo rows needed by the interpolation stencils and the SVDs of the frames
+are computed by a tall skinny QR decomposition (TSQR) followed by a small SVD on the root rank.
+
+Run with:   mpirun -n 4 python my_script.py
+(see examples/04_mpi_moving_blobs_2D.py)
+
+"""
+############################
+# import MODULES here:
+############################
+import numpy as np
+from numpy.linalg import norm, svd, qr
+import time
+from mpi4py import MPI
+from transforms import BatchedOperator, compute_map_operator, shift_map, rotation_map
+from sPOD_tools import frame, ReturnValue
+
+
+###############################################################################
+# row partition and reductions
+###############################################################################
+
+def row_partition(M, comm = None):
+    """
+    Returns the slice of the rows of an M x N matrix, which belong to the rank of comm.
+    The rows are split into comm.size contiguous blocks of (almost) equal size.
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    bounds = np.linspace(0, M, comm.size + 1).astype(int)
+    return slice(bounds[comm.rank], bounds[comm.rank + 1])
+
+def distributed_norm(X_local, comm = None):
+    """
+    Returns the Frobenius norm of the row partitioned matrix X
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    return np.sqrt(comm.allreduce(norm(X_local)**2))
+
+def tsqr(A_local, comm = None):
+    """
+    Tall skinny QR decomposition A = Q R of the row partitioned matrix A:
+    every rank computes the QR decomposition of its rows, the R factors are stacked and
+    decomposed again on the root rank.
+
+    :return: Q_local (rows of Q on this rank), R (on every rank)
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    Q1, R1 = qr(A_local)
+    R_list = comm.gather(R1, root=0)
+    if comm.rank == 0:
+        Q2, R = qr(np.concatenate(R_list, axis=0))
+        bounds = np.cumsum([0] + [np.shape(R_k)[0] for R_k in R_list])
+        Q2_blocks = [Q2[bounds[k]:bounds[k + 1]] for k in range(comm.size)]
+    else:
+        R, Q2_blocks = None, None
+    Q2_local = comm.scatter(Q2_blocks, root=0)
+    R = comm.bcast(R, root=0)
+    return np.dot(Q1, Q2_local), R
+
+def distributed_svd(A_local, r, comm = None):
+    """
+    Truncated SVD A = U S VT of the row partitioned matrix A with r modes.
+    The SVD of the small R factor of the TSQR is computed on the root rank.
+
+    :return: U_local (rows of U on this rank), S, VT (on every rank)
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    Q_local, R = tsqr(A_local, comm)
+    if comm.rank == 0:
+        U_R, S, VT = svd(R, full_matrices=False)
+        svd_R = (U_R[:, :r], S[:r], VT[:r, :])
+    else:
+        svd_R = None
+    U_R, S, VT = comm.bcast(svd_R, root=0)
+    return np.dot(Q_local, U_R), S, VT
+
+
+###############################################################################
+# CLASS of distributed transformations
+###############################################################################
+
+class distributed_transforms:
+    """
+    Transformation acting on the rows of the snapshot matrix, which belong to one rank.
+    The batched operators (T^k, T^(-k)) are only set up for the local rows, directly from the coordinate
+    maps of the shifts and rotations at the local grid points (see transforms.compute_map_operator).
+    Before every application the rows, which are needed by the stencils of the local rows
+    (halo), are exchanged between the ranks.
+    For shifts larger than the local slab the halo grows accordingly.
+    """
+
+    def __init__(self, data_shape, domain_size, trafo_type = "shift", shifts = None, dx = None, rotations = None,
+                 rotation_center = None, interp_order = 3, rows = None, comm = None):
+        """
+        The parameters are the same as for transforms (all given for the global grid), except:
+
+        :param interp_order: order 1, 3 or 5 of the Lagrange interpolation or a list [order_forward, order_backward]
+        :param rows: slice of the local rows (default: row_partition)
+        :param comm: MPI communicator (default: MPI.COMM_WORLD)
+        """
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        M = np.prod(data_shape[:3])
+        self.rows = row_partition(M, self.comm) if rows is None else rows
+        self.Ntime = data_shape[3]
+        self.M_local = self.rows.stop - self.rows.start
+        self.data_shape = [self.M_local, 1, 1, self.Ntime]
+        self.dim = np.size(dx)
+        self.trafo_type = trafo_type
+        all_rows = self.comm.allgather((self.rows.start, self.rows.stop))
+        if trafo_type == "identity":
+            self.halo_pos, self.halo_neg = None, None
+            return
+        if not isinstance(interp_order, list):
+            interp_order = [interp_order, interp_order]
+
+        # grid points of the local rows, every grid point has Nvar rows
+        Ngrid = list(data_shape[:self.dim])
+        Nvar = M // np.prod(Ngrid)
+        grid_points = np.arange(self.rows.start // Nvar, (self.rows.stop - 1) // Nvar + 1)
+        local_rows = slice(self.rows.start - grid_points[0] * Nvar, self.rows.stop - grid_points[0] * Nvar)
+        halos = []
+        for sign, order in zip([1, -1], interp_order):
+            maps = {}
+            if shifts is not None:
+                maps["shift"] = shift_map(sign * np.asarray(shifts), domain_size, dx, grid_points)
+            if rotations is not None:
+                maps["rotation"] = rotation_map(sign * np.asarray(rotations), rotation_center, dx, Ngrid)
+            if trafo_type == "shiftRot":
+                # T q = shift(rotate(q)) and T^(-1) q = rotate^(-1)(shift^(-1)(q))
+                maps = [maps["shift"], maps["rotation"]][::sign]
+            else:
+                maps = [maps[trafo_type]]
+            operator = compute_map_operator(maps, Ngrid, self.Ntime, Nvar, order, grid_points)
+            halos.append(self.setup_halo(operator.idx[:, local_rows, :], operator.weights[:, local_rows, :], all_rows))
+        self.halo_pos, self.halo_neg = halos
+
+    def setup_halo(self, idx, weights, all_rows):
+        """
+        Sets up the exchange of the halo rows for the local rows of the operator, given by the global gather
+        indices idx and the weights. The gather indices of the local operator refer to the rows of the halo buffer.
+        """
+        needed = np.unique(idx)
+        # rows every rank needs from the other ranks
+        requests = [needed[(needed >= start) & (needed < stop)] for start, stop in all_rows]
+        sends = self.comm.alltoall(requests)
+        local_op = BatchedOperator(np.searchsorted(needed, idx), weights)
+        return {"operator": local_op, "sends": [rows_p - self.rows.start for rows_p in sends],
+                "Nhalo": np.size(needed)}
+
+    def exchange_halo(self, field, halo):
+        """
+        Returns the rows of the global field needed by the local operator
+        """
+        recvs = self.comm.alltoall([field[rows_p] for rows_p in halo["sends"]])
+        return np.concatenate(recvs, axis=0)
+
+    def transform(self, field, halo, out = None, accumulate = False):
+        input_shape = np.shape(field)
+        field = np.reshape(field, [self.M_local, self.Ntime])
+        if halo is None:
+            if out is None:
+                return np.reshape(field.copy(), input_shape)
+            out_mat = np.reshape(out, [self.M_local, self.Ntime])
+            if accumulate:
+                out_mat += field
+            else:
+                out_mat[...] = field
+            return out
+        field_halo = self.exchange_halo(field, halo)
+        if out is None:
+            out_mat = np.empty([self.M_local, self.Ntime], dtype=np.result_type(field, halo["operator"].weights))
+            accumulate = False
+        else:
+            out_mat = np.reshape(out, [self.M_local, self.Ntime])
+            assert np.shares_memory(out_mat, out), "out has to be a contiguous array"
+        halo["operator"].apply(field_halo, out=out_mat, accumulate=accumulate)
+        if out is not None:
+            return out
+        return np.reshape(out_mat, input_shape)
+
+    def apply(self, field, out = None, accumulate = False):
+        """
+        Returns the local rows of T^k[field] (collective call)
+        """
+        return self.transform(field, self.halo_pos, out, accumulate)
+
+    def reverse(self, field, out = None, accumulate = False):
+        """
+        Returns the local rows of T^(-k)[field] (collective call)
+        """
+        return self.transform(field, self.halo_neg, out, accumulate)
+
+
+###############################################################################
+# distributed shifted POD
+###############################################################################
+
+def shifted_POD_mpi(snapshot_local, transforms, nmodes, eps, Niter=1, dtol = 1e-7, comm = None):
+    """
+    Distributed memory version of shifted_POD. Every rank calls this routine with its rows of the snapshot matrix.
+    The frames are computed with distributed_svd and all norms are reduced over the ranks.
+
+    :param snapshot_local: rows of the M x N snapshot matrix on this rank
+    :param transforms: list of distributed_transforms
+    :param nmodes: number of modes allowed in each frame
+    :param eps: stopping criteria
+    :param Niter: maximal number of iterations
+    :param dtol: stops the algorithm if the relative residual doesnt change for 5 iterations more then dtol
+    :param comm: MPI communicator (default: MPI.COMM_WORLD)
+    :return: ReturnValue, where the modes of the frames and the approximation contain only the local rows
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    q = snapshot_local
+    Nframes = len(transforms)
+    if np.size(nmodes) != Nframes:
+        nmodes = list([nmodes]) * Nframes
+    qtilde_frames = [frame(trafo, number_of_modes=nmodes[k]) for k, trafo in enumerate(transforms)]
+    qtilde = np.zeros_like(q)
+    norm_q = distributed_norm(q, comm)
+
+    it = 0
+    rel_err = 1
+    rel_err_list = []
+    while rel_err > eps and it < Niter:
+        it += 1  # counts the number of iterations in the loop
+        res = q - qtilde
+        rel_err = distributed_norm(res, comm) / norm_q
+        rel_err_list.append(rel_err)
+
+        t = time.time()
+        qtilde[...] = 0
+        for k, (trafo, q_frame) in enumerate(zip(transforms, qtilde_frames)):
+            field = trafo.reverse(res) / Nframes
+            if it > 1:
+                field += q_frame.field()
+            U, S, VT = distributed_svd(field, nmodes[k], comm)
+            q_frame.modal_system = {"U": U, "sigma": S, "VT": VT}
+            qtilde += q_frame.lab_field()
+        elapsed = time.time() - t
+        if comm.rank == 0:
+            print("it=%d rel_err= %4.4e t_cpu = %2.2f" % (it, rel_err, elapsed))
+        if it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1]):
+            break
+
+    return ReturnValue(qtilde_frames, qtilde, rel_err_list)
@@ -20,16 +20,19 @@ import matplotlib.pyplot as plt
 from numpy import exp, meshgrid, mod,size, interp, where, diag, reshape, \
                     asarray
 from sklearn.utils.extmath import randomized_svd
-from numpy.linalg import lstsq, norm, svd
+from numpy.linalg import lstsq, norm, svd, qr
 #from scipy.linalg import svd
 import os
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.pyplot import   subplot, plot, pcolor, semilogy, title, \
                                 xlabel, ylabel, figure
 from warnings import warn
 ###############################
 # sPOD general SETTINGS:
 ###############################
+FRAME_CACHE_SIZE = 2**30  # default maximal memory (in bytes) of the cached fields of each frame
 # %%
 ###############################################################################
 # CLASS of CO MOVING FRAMES
@@ -42,10 +45,18 @@ class frame:
         The frame is represented by an orthogonal system.
     """
 
-    def __init__(self, transform=None, field=None, number_of_modes=None, fname = None):
+    def __init__(self, transform=None, field=None, number_of_modes=None, fname = None, cache_max_size = None,
+                 seed = None):
         """
         Initialize a co moving frame.
+        cache_max_size is the maximal memory in bytes of the cached fields (see lab_field), default is FRAME_CACHE_SIZE.
+        seed initializes the random number generator of the frame, which is used by the randomized SVDs.
+        If None, the seed is drawn from numpy.random, such that np.random.seed makes the results reproducible.
+        Since every frame has its own generator, the frames can be updated concurrently.
         """
+        self.cache_max_size = FRAME_CACHE_SIZE if cache_max_size is None else cache_max_size
+        self._cache = {}
+        self.rng = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
         if fname:
             self.load(fname)
             self.Nmodes = np.sum(self.modal_system["sigma"] > 0)
@@ -67,6 +78,12 @@ class frame:
                 self.set_orthonormal_system(field)
             #print("We have initialiced a new field!")
 
+    def __getstate__(self):
+        # the cached fields are not saved
+        state = self.__dict__.copy()
+        state.pop("_cache", None)
+        return state
+
     def save(self, fname):
         with open(fname, 'wb') as f:
             pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
@@ -78,13 +95,18 @@ class frame:
         self.modal_system = frame_load.modal_system
 
 
-    def reduce(self, field, r, use_rSVD = False):
+    def reduce(self, field, r, use_rSVD = False, use_warmstart = False):
         """
         Reduce the full filed using the first N modes of the Singular
-        Value Decomposition
+        Value Decomposition.
+        If use_warmstart is true, the truncated SVD is computed by subspace iteration
+        starting from the right singular vectors of the current modal system.
         """
         if use_rSVD == True:
-            u, s, vt = randomized_svd(field, n_components=r)
+            u, s, vt = randomized_svd(field, n_components=r, random_state=int(self.rng.integers(2**31)))
+        elif use_warmstart == True:
+            VT0 = self.modal_system["VT"] if hasattr(self, "modal_system") else None
+            u, s, vt = truncated_svd(field, r, VT0, rng=self.rng)
         else:
             [U, S, VT] = svd(field, full_matrices=False)
             s = S[:r]
@@ -93,7 +115,7 @@ class frame:
         
         return u, s, vt
         
-    def set_orthonormal_system(self, field, use_rSVD = False):
+    def set_orthonormal_system(self, field, use_rSVD = False, use_warmstart = False):
         """
         In this routine we set the orthonormal vectors of the SVD in the 
         corresponding frames.
@@ -103,10 +125,91 @@ class frame:
         X = reshape(field, [-1, self.Ntime])
         # make an singular value decomposition of the snapshot matrix
         # and reduce it to the specified numer of moddes
-        [U, S, VT] = self.reduce(X, self.Nmodes, use_rSVD)
+        [U, S, VT] = self.reduce(X, self.Nmodes, use_rSVD, use_warmstart)
         # the snapshot matrix is only stored with reduced number of SVD modes
         self.modal_system = {"U": U, "sigma": S, "VT": VT}
 
+    def update(self, residual, weight = 1, n_iter = 1, n_oversamples = 5):
+        """
+        Updates the modal system to the rank Nmodes approximation of
+            X = U*S*VT + weight * residual
+        without building the dense field U*S*VT.
+        The range of the update is sampled with a randomized range finder, split into
+        span(U) and its orthogonal complement and the new modes are computed from the SVD
+        of the small core matrix. Apart from the residual only M x (2*Nmodes+n_oversamples)
+        arrays are allocated.
+        """
+        R = reshape(residual, [-1, self.Ntime])
+        U = self.modal_system["U"]
+        S = self.modal_system["sigma"]
+        VT = self.modal_system["VT"]
+        r = self.Nmodes
+        if r is None or r <= 0 or 2 * r + n_oversamples >= min(np.shape(R)):
+            # nothing to gain: update the dense field
+            self.set_orthonormal_system(self.build_field() + weight * R)
+            return
+
+        # products with X and X^T using only the factors and the residual
+        X_dot = lambda Z: U @ (S[:, None] * (VT @ Z)) + weight * (R @ Z)
+        XT_dot = lambda Y: VT.T @ (S[:, None] * (U.T @ Y)) + weight * (R.T @ Y)
+
+        # randomized range finder of X
+        Y = X_dot(self.rng.standard_normal((self.Ntime, r + n_oversamples)).astype(R.dtype))
+        for i in range(n_iter):
+            Y, _ = qr(Y)
+            Y = X_dot(XT_dot(Y))
+        # part of the range orthogonal to span(U) (orthogonalized twice for stability)
+        for i in range(2):
+            Y = Y - U @ (U.T @ Y)
+            Y, _ = qr(Y)
+        Q = np.concatenate([U, Y], axis=1)
+        # svd of the core matrix B = Q^T X
+        [Ub, Snew, VTnew] = svd(XT_dot(Q).T, full_matrices=False)
+        self.modal_system = {"U": Q @ Ub[:, :r], "sigma": Snew[:r], "VT": VTnew[:r, :]}
+
+    def extend_time(self, Ntime_new):
+        """
+        Appends Ntime_new time steps with zero field to the frame
+        """
+        VT = self.modal_system["VT"]
+        self.modal_system = {"U": self.modal_system["U"], "sigma": self.modal_system["sigma"],
+                             "VT": np.concatenate([VT, np.zeros([np.shape(VT)[0], Ntime_new], dtype=VT.dtype)], axis=1)}
+        self.Ntime += Ntime_new
+        self.data_shape = [*self.data_shape[:3], self.Ntime]
+
+    def update_columns(self, ts, X):
+        """
+        Replaces the columns ts of the field by X (Brand's incremental SVD):
+            U*S*VT + (X - U*S*VT[:, ts]) * E_ts^T
+        where E_ts selects the columns ts. The new modal system is truncated to Nmodes modes.
+        Only arrays of size M x (r + Nts) and Ntime x (r + Nts) are needed, with r beeing the rank of the frame.
+        """
+        U, S, V = self.modal_system["U"], self.modal_system["sigma"], self.modal_system["VT"].T
+        X = reshape(X, [np.shape(U)[0], -1])
+        Nts = np.shape(X)[1]
+        A = X - (U * S) @ V[ts, :].T
+        B = np.zeros([self.Ntime, Nts])
+        B[ts, :] = np.eye(Nts)
+        # orthogonal complements of the update in the column and row space
+        m = U.T @ A
+        P, Ra = qr(A - U @ m)
+        n = V.T @ B
+        Q, Rb = qr(B - V @ n)
+        r = len(S)
+        K = np.zeros([r + Nts, r + Nts])
+        K[:r, :r] = np.diag(S)
+        K += np.concatenate([m, Ra]) @ np.concatenate([n, Rb]).T
+        [Uk, Sk, VTk] = svd(K)
+        rank = self.Nmodes if self.Nmodes is not None and self.Nmodes > 0 else len(Sk)
+        self.modal_system = {"U": np.concatenate([U, P], axis=1) @ Uk[:, :rank], "sigma": Sk[:rank],
+                             "VT": VTk[:rank, :] @ np.concatenate([V, Q], axis=1).T}
+
+    def astype(self, dtype):
+        """
+        Converts the modal system to the floating point type dtype
+        """
+        self.modal_system = {key: value.astype(dtype) for key, value in self.modal_system.items()}
+
     def smoothen_time_amplitudes(self, TV_iterations = 100, clambda =1):
         """
         This function enforces smoothness of the time amplitudes:
@@ -138,6 +241,49 @@ class frame:
         # add up all the modes A=U * S * VH
         return np.dot(u * s, vh)
 
+    def version(self):
+        """
+        Returns the current version of the modal system and the transformation. It changes whenever
+        the modal system, one of its entries or the transformation is replaced.
+        """
+        ms = self.modal_system
+        return (ms, ms["U"], ms["sigma"], ms["VT"], getattr(self, "trafo", None))
+
+    def cached(self, name, rank, compute):
+        """
+        Returns the cached array (name, rank) if it was computed from the current version of
+        the modal system and the transformation. Otherwise it is computed with compute() and cached read-only.
+        If the cache exceeds cache_max_size, the largest arrays are evicted first.
+        """
+        cache = self.__dict__.setdefault("_cache", {})
+        version = self.version()
+        # drop everything computed from an old modal system or transformation
+        for key in [key for key, (v, _) in cache.items() if not all(a is b for a, b in zip(v, version))]:
+            del cache[key]
+        if (name, rank) in cache:
+            return cache[(name, rank)][1]
+
+        value = compute()
+        value.flags.writeable = False
+        cache[(name, rank)] = (version, value)
+        max_size = getattr(self, "cache_max_size", FRAME_CACHE_SIZE)
+        while cache and sum(v.nbytes for _, v in cache.values()) > max_size:
+            del cache[max(cache, key=lambda key: cache[key][1].nbytes)]
+        return value
+
+    def field(self, rank = None):
+        """
+        Cached and read-only version of build_field(rank)
+        """
+        return self.cached("field", rank, lambda: self.build_field(rank))
+
+    def lab_field(self, rank = None):
+        """
+        Returns the cached and read-only field in the labratory frame: T^k[q^k] = trafo.apply(build_field(rank))
+        Only the field in the labratory frame is cached, the field in the co-moving frame is a temporary.
+        """
+        return self.cached("lab_field", rank, lambda: self.trafo.apply(self.build_field(rank)))
+
 
     def plot_singular_values(self):
         """
@@ -184,18 +330,69 @@ class frame:
 
         return self
 
+# %%
+###############################################################################
+# truncated SVD
+###############################################################################
+
+def truncated_svd(X, r, VT0=None, tol=1e-10, max_iter=100, n_oversamples=5, rng=None):
+    """
+    Computes the first r singular values and vectors of X (M x N) by block subspace iteration.
+    Every iteration costs O(M*N*(r+n_oversamples)) instead of O(M*N*min(M,N)) for the full SVD.
+    The iteration stops if the residuals of the singular triplets are small:
+        max_i || X v_i - sigma_i u_i || <= tol * sigma_1
+    If the starting block is close to the singular vectors, only few iterations are needed.
+
+    :param X: M x N matrix
+    :param r: number of singular values/vectors
+    :param VT0: right singular vectors of a nearby matrix (e.g. of the last sPOD iteration),
+                used as starting block. If None, the starting block is random.
+    :param tol: relative tolerance of the residuals
+    :param max_iter: maximal number of subspace iterations
+    :param n_oversamples: additional vectors in the block to improve the accuracy of the last modes
+    :param rng: numpy.random.Generator of the starting block (default: numpy.random)
+    :return: U, S, VT
+    """
+    M, N = np.shape(X)
+    if r is None or r <= 0 or r + n_oversamples >= min(M, N):
+        # the subspace is not smaller than the matrix: use the full svd
+        [U, S, VT] = svd(X, full_matrices=False)
+        return U[:, :r], S[:r], VT[:r, :]
+
+    # starting block: old right singular vectors, filled up with random vectors
+    k = r + n_oversamples
+    rng = np.random if rng is None else rng
+    Omega = rng.standard_normal((N, k)).astype(X.dtype)
+    if VT0 is not None and np.shape(VT0)[1] == N:
+        n0 = min(np.shape(VT0)[0], k)
+        Omega[:, :n0] = VT0[:n0, :].T
+    XV = X @ Omega
+    for i in range(max_iter):
+        Q, _ = qr(XV)
+        # svd of the small projected matrix B = Q^T X (Rayleigh-Ritz)
+        [Ub, S, VT] = svd((X.T @ Q).T, full_matrices=False)
+        U = Q @ Ub
+        XV = X @ VT.T
+        residual = np.max(norm(XV[:, :r] - U[:, :r] * S[:r], axis=0))
+        if residual <= tol * S[0]:
+            break
+
+    return U[:, :r], S[:r], VT[:r, :]
+
 # %%
 ###############################################################################
 # build frames
 ###############################################################################
 
-def build_all_frames(frames, trafos = None, ranks = None):
+def build_all_frames(frames, trafos = None, ranks = None, time_indices = None, space_indices = None):
     """
     Build up the truncated data field from the result of
      the sPOD decomposition
     :param frames: List of frames q_k , k = 1,...,F
     :param trafos: List of transformations T^k
-    :param ranks: integer number r_k > 0
+    :param ranks: integer number r_k > 0 or list/tuple with the rank of every frame (a rank 0 frame is left out)
+    :param time_indices: if given, only the snapshots q[:, time_indices] are computed (slice or array of indices)
+    :param space_indices: if given, only the rows q[space_indices, :] are computed (slice or array of indices)
     :return: q = sum_k T^k q^k where q^k is of rank r_k
     """
     if trafos is None:
@@ -207,49 +404,185 @@ def build_all_frames(frames, trafos = None, ranks = None):
     else:
         ranks = [frame.Nmodes for frame in frames]
 
-    qtilde = 0
+    if time_indices is not None or space_indices is not None:
+        return build_frames_subset(frames, trafos, ranks, time_indices, space_indices)
+
+    qtilde = None
+    for k, (trafo, frame) in enumerate(zip(trafos, frames)):
+        if ranks[k] == 0:
+            continue
+        if trafo is frame.trafo:
+            qframe_lab = frame.lab_field(ranks[k])
+        elif qtilde is not None:
+            trafo.apply(frame.field(ranks[k]), out=qtilde, accumulate=True)
+            continue
+        else:
+            qframe_lab = trafo.apply(frame.field(ranks[k]))
+        if qtilde is None:
+            qtilde = qframe_lab.copy()
+        else:
+            qtilde += qframe_lab
+
+    if qtilde is None:
+        # all frames have rank 0
+        qtilde = np.zeros([np.prod(frames[0].data_shape[:3]), frames[0].Ntime],
+                          dtype=np.result_type(*[f.modal_system["U"] for f in frames]))
+    return qtilde
+
+def build_frames_subset(frames, trafos, ranks, time_indices = None, space_indices = None):
+    """
+    Computes the rows space_indices of the snapshots time_indices of q = sum_k T^k q^k.
+    Only the time slices time_indices of the transformations are applied. If the transformation is given by batched
+    operators, the frames are only built at the grid points, which are needed for the interpolation of space_indices.
+    """
+    M, N = np.prod(frames[0].data_shape[:3]), frames[0].Ntime
+    ts = slice(0, N) if time_indices is None else time_indices
+    rows = np.arange(M) if space_indices is None else np.arange(M)[space_indices]
+    Nt = np.size(np.arange(N)[ts])
+    qtilde = np.zeros([np.size(rows), Nt], dtype=np.result_type(*[f.modal_system["U"] for f in frames]))
     for k, (trafo, frame) in enumerate(zip(trafos, frames)):
-            qtilde += trafo.apply(frame.build_field(ranks[k]))
+        if ranks[k] == 0:
+            continue
+        r = ranks[k]
+        U, S, VT = frame.modal_system["U"][:, :r], frame.modal_system["sigma"][:r], frame.modal_system["VT"][:r, ts]
+        operators = trafo.operators()
+        if operators is not None:
+            # restrict T^k to the requested rows and time steps
+            operator = operators[0].select_time(ts)
+            idx = operator.idx[:, rows, :]
+            needed, idx_needed = np.unique(idx, return_inverse=True)
+            operator = type(operator)(np.reshape(idx_needed, np.shape(idx)), operator.weights[:, rows, :])
+            operator.apply(np.dot(U[needed] * S, VT), out=qtilde, accumulate=True)
+        else:
+            qtilde += trafo.select_time(ts).apply(np.dot(U * S, VT))[rows]
 
     return qtilde
 
-def reconstruction_error(snapshotmatrix, frames, trafos = None, max_ranks = None):
+def build_frames_blockwise(frames, trafos = None, ranks = None, time_indices = None, space_indices = None,
+                           block_size = 100):
+    """
+    Generator, which returns the approximation q = sum_k T^k q^k block by block in time, such that
+    the full approximation is never stored:
+
+        for ts, q_block in build_frames_blockwise(frames, block_size=50):
+            ...  # q_block = q[space_indices, ts]
+
+    :param block_size: number of snapshots of every block
+    :return: time indices of the block, rows space_indices of the block (see build_all_frames for the other parameters)
+    """
+    N = frames[0].Ntime
+    time_indices = np.arange(N) if time_indices is None else np.arange(N)[time_indices]
+    for i in range(0, np.size(time_indices), block_size):
+        ts = time_indices[i:i + block_size]
+        yield ts, build_all_frames(frames, trafos, ranks, ts, space_indices)
+
+def lab_mode_products(snapshotmatrix, frames, trafos = None, max_ranks = None, block_size = None):
+    """
+    Computes the inner products of the rank one contributions B_(k,i) = T^k(u_i sigma_i v_i^T)
+    of all frames in the labratory frame:
+        G[(k,i),(l,j)] = <B_(k,i), B_(l,j)>   and   b[(k,i)] = <B_(k,i), q>
+    The products are accumulated over time blocks of block_size snapshots, in which the modes are transformed:
+        <B_(k,i), B_(l,j)> = sum_t sigma_i v_i(t) sigma_j v_j(t) <T^k(t) u_i, T^l(t) u_j>
+
+    :param max_ranks: list with the number of modes r_k of every frame (default: all modes)
+    :param block_size: number of snapshots, which are transformed at once. The transformed modes of a block
+                       need M x R x block_size values. By default block_size is chosen, such that
+                       they are not larger than the snapshot matrix.
+    :return: G (R x R), b (R), where R = sum_k r_k and the modes are ordered frame by frame
+    """
+    if trafos is None:
+        trafos = [f.trafo for f in frames]
+    if max_ranks is None:
+        max_ranks = [np.shape(f.modal_system["U"])[1] for f in frames]
+    q = snapshotmatrix
+    M, N = np.shape(q)
+    R = int(np.sum(max_ranks))
+    if block_size is None:
+        block_size = max(N // max(R, 1), 1)
+    G = np.zeros([R, R])
+    b = np.zeros(R)
+    for t_start in range(0, N, block_size):
+        ts = slice(t_start, min(t_start + block_size, N))
+        Nt = ts.stop - ts.start
+        # A[:, (k,i), t] = T^k(t) u_i * sigma_i v_i(t)
+        A = np.empty([M, R, Nt])
+        i0 = 0
+        for trafo, q_frame, r in zip(trafos, frames, max_ranks):
+            trafo_block = trafo.select_time(ts)
+            U, S, VT = q_frame.modal_system["U"], q_frame.modal_system["sigma"], q_frame.modal_system["VT"]
+            for i in range(r):
+                A[:, i0 + i, :] = trafo_block.apply(np.repeat(U[:, i:i+1], Nt, axis=1)) * (S[i] * VT[i, ts])
+            i0 += r
+        G += np.einsum("mit,mjt->ij", A, A, optimize=True)
+        b += np.einsum("mit,mt->i", A, q[:, ts], optimize=True)
+    return G, b
+
+def reconstruction_error(snapshotmatrix, frames, trafos = None, max_ranks = None, block_size = None):
     """
-    :param frames: snapshotmatrix of all input data used to compute the frames
+    Computes the smallest relative error ||q - sum_k T^k q^k|| / ||q|| for every number of degrees of freedom
+    dof = sum_k r_k, where q^k is the frame k truncated to r_k <= max_ranks[k] modes.
+    The error of every rank combination is evaluated from the inner products of the rank one contributions
+    of the modes (see lab_mode_products):
+        ||q - qtilde||^2 = ||q||^2 - 2 sum_(k,i) b[(k,i)] + sum_((k,i),(l,j)) G[(k,i),(l,j)]
+    Since the error is computed from squared norms, relative errors below 1e-7 are not resolved.
+
+    :param snapshotmatrix: snapshotmatrix of all input data used to compute the frames
     :param frames: List of frames q_k , k = 1,...,F
     :param trafos: List of transformations T^k
-    :param ranks: integer number r_k > 0
-    :return: q = sum_k T^k q^k where q^k is of rank r_k
+    :param max_ranks: maximal number of modes r_k of every frame (integer or list)
+    :param block_size: number of snapshots, which are transformed at once (see lab_mode_products)
+    :return: error_matrix, where row dof contains the ranks r_1, ..., r_F with the smallest error and the error
     """
-    import itertools
     if trafos is None:
         trafos = [f.trafo for f in frames]
+    Nframes = len(frames)
 
     if max_ranks is not None:
         if type(max_ranks) == int:
-            ranks = [max_ranks]*len(trafos)
+            max_ranks = [max_ranks]*len(trafos)
     else:
         max_ranks = [frame.Nmodes for frame in frames]
 
-    possible_ranks_list = [np.arange(max_rank+1) for max_rank in max_ranks]
-    possible_ranks_list = list(itertools.product(*possible_ranks_list))
-    Nlist = len(possible_ranks_list)
+    # modes, which are available in every frame
+    nmodes = [min(max_rank, np.shape(frame.modal_system["U"])[1]) for max_rank, frame in zip(max_ranks, frames)]
+    G, b = lab_mode_products(snapshotmatrix, frames, trafos, nmodes, block_size)
     norm_q = norm(snapshotmatrix,ord="fro")
+
+    # cumulative sums over the first r_k modes, which are constant for r_k > nmodes[k]
+    bounds = np.cumsum([0] + nmodes)
+    rank_index = [np.minimum(np.arange(max_rank + 1), n) for max_rank, n in zip(max_ranks, nmodes)]
+    err2 = norm_q**2
+    for k in range(Nframes):
+        b_k = np.concatenate([[0], np.cumsum(b[bounds[k]:bounds[k + 1]])])[rank_index[k]]
+        shape = [1] * Nframes
+        shape[k] = -1
+        err2 = err2 - 2 * np.reshape(b_k, shape)
+        for l in range(k, Nframes):
+            G_kl = np.pad(np.cumsum(np.cumsum(G[bounds[k]:bounds[k + 1], bounds[l]:bounds[l + 1]], axis=0), axis=1),
+                          [(1, 0), (1, 0)])[np.ix_(rank_index[k], rank_index[l])]
+            shape = [1] * Nframes
+            shape[k] = np.size(rank_index[k])
+            if l != k:
+                # the products of frame k and l appear twice
+                shape[l] = np.size(rank_index[l])
+                err2 = err2 + 2 * np.reshape(G_kl, shape)
+            else:
+                err2 = err2 + np.reshape(np.diag(G_kl), shape)
+    rel_err = np.sqrt(np.maximum(err2, 0)) / norm_q
+    dofs = sum(np.reshape(np.arange(max_rank + 1), [-1 if ax == k else 1 for ax in range(Nframes)])
+               for k, max_rank in enumerate(max_ranks))
+    dofs = np.broadcast_to(dofs, np.shape(rel_err))
+    print("evaluated errors of %d rank combinations" % np.size(rel_err))
+
     max_dof = np.sum(np.asarray(max_ranks)+1)
-    error_matrix = 2*np.ones([max_dof-1,3])
-    for iter,ranks in enumerate(possible_ranks_list):
-
-        qtilde = np.zeros_like(snapshotmatrix)
-        for k, (trafo, frame) in enumerate(zip(trafos, frames)):
-            if ranks[k]>0:
-                qtilde += trafo.apply(frame.build_field(ranks[k]))
-        rel_err = norm(qtilde - snapshotmatrix, ord="fro")/norm_q
-        dof = np.sum(ranks)
-        print(" iter = %d/%d ranks = "%(iter+1,Nlist)+ " ".join(map(str,ranks)) + " error = %1.1e"%rel_err)
-        if rel_err < error_matrix[dof,-1]:
-            error_matrix[dof, -1] = rel_err
-            for ir, r in enumerate(ranks):
-                error_matrix[dof, ir] = r
+    error_matrix = 2*np.ones([max_dof-1,Nframes+1])
+    for dof in range(max_dof-Nframes+1):
+        # the first combination with the smallest error (in the order of itertools.product)
+        errors = np.where(dofs == dof, rel_err, np.inf)
+        iopt = np.argmin(errors)
+        if errors.flat[iopt] < error_matrix[dof, -1]:
+            error_matrix[dof, -1] = errors.flat[iopt]
+            error_matrix[dof, :Nframes] = np.unravel_index(iopt, np.shape(errors))
 
     return error_matrix
 
@@ -300,16 +633,33 @@ def shrink(X, tau):
     """
     return np.sign(X)*np.maximum(np.abs(X)-tau, 0)
 
-def SVT(X, mu, nmodes_max = None, use_rSVD = False):
+def SVT(X, mu, nmodes_max = None, use_rSVD = False, rank_guess = None, n_buffer = 5, random_state = None):
     """
     Proximal Operator for schatten 1 norm minimization
     :param X: input matrix for thresholding
     :param mu: threshold
+    :param rank_guess: expected number of singular values above mu (e.g. the rank of the last iteration).
+                       If given, only rank_guess + n_buffer singular values are computed with the randomized SVD.
+                       Their number is doubled until the smallest computed singular value is below mu.
+    :param random_state: seed or numpy.random.RandomState of the randomized SVDs (default: global numpy.random state)
     :return: argmin_X1 mu|| X1 ||_* + 1/2|| X1 - X||_F^2
     """
-    if nmodes_max:
+    if rank_guess is not None:
+        nmax = min(np.shape(X))
+        if nmodes_max:
+            nmax = min(nmodes_max, nmax)
+        k = min(rank_guess + n_buffer, nmax)
+        while k < nmax:
+            u, s, vt = randomized_svd(X, n_components=k, random_state=random_state)
+            if s[-1] <= mu:
+                break
+            k = min(2 * k, nmax)
+        if k >= nmax:
+            # all singular values are needed
+            u, s, vt = SVT(X, 0, nmodes_max, use_rSVD, random_state=random_state)
+    elif nmodes_max:
         if use_rSVD:
-            u, s, vt = randomized_svd(X, n_components=nmodes_max)
+            u, s, vt = randomized_svd(X, n_components=nmodes_max, random_state=random_state)
         else:
             u, s, vt = svd(X, full_matrices=False)
             s = s[:nmodes_max]
@@ -356,7 +706,7 @@ class ReturnValue:
     """
     This class inherits all return values of the shifted POD routines
     """
-    def __init__(self, frames, approximation, relaltive_error_hist = None, error_matrix = None, ranks = None, ranks_hist = None):
+    def __init__(self, frames, approximation, relaltive_error_hist = None, error_matrix = None, ranks = None, ranks_hist = None, mu_hist = None, windows = None):
      self.frames = frames               # list of all frames
      self.data_approx = approximation   # approximation of the snapshot data
      if relaltive_error_hist is not None:
@@ -367,11 +717,18 @@ class ReturnValue:
          self.ranks = ranks
      if ranks_hist is not None:
          self.ranks_hist = ranks_hist
+     if mu_hist is not None:
+         self.mu_hist = mu_hist
+     if windows is not None:
+         self.windows = windows
 
 ###############################################################################
 # distribute the residual of frame
 ###############################################################################        
-def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = False,dtol = 1e-7, total_variation_iterations = -1):
+def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = False,dtol = 1e-7, total_variation_iterations = -1,
+                use_warmstart = False, use_lowrank_update = False, n_workers = 1,
+                acceleration = None, anderson_depth = 3, adaptive_step = False, dtype = None, refine_iterations = 0,
+                initial_frames = None):
     """
     :param snapshot_matrix: M x N matrix with N beeing the number of snapshots, M is the ODE dimension
     :param transforms: Transformations
@@ -382,6 +739,23 @@ def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = Fa
     :param use_rSVD: if true: uses the randomiced singular value decomposition (make sure it does not influence the results!)
     :param dtol: stops the algorithm if the relative residual doesnt change for 5 iterations more then dtol
     :param total_variation_iterations: number of total variation steps for each sPOD iteration. good value is 20
+    :param use_warmstart: if true: the truncated SVD of each frame is computed by subspace iteration, which is
+                          started from the modes of the previous iteration (see truncated_svd)
+    :param use_lowrank_update: if true: the frames are updated with frame.update, which avoids building
+                               the dense field of each frame
+    :param n_workers: number of threads that update the frames concurrently (None or <1: number of cpus).
+                      The results do not depend on the number of workers.
+    :param acceleration: None: plain residual distribution
+                         "nesterov": FISTA momentum with restart if the error increases
+                         "anderson": Anderson acceleration of the frame iterates (see anderson_acceleration)
+    :param anderson_depth: number of previous iterates used by the Anderson acceleration
+    :param adaptive_step: if true: the step size of every frame (initially 1/Nframes) is adapted in every iteration,
+                          such that the update of the frame reduces the residual best
+    :param dtype: floating point type of the computation, e.g. np.float32 halves the memory and speeds up the SVDs.
+                  The snapshots, transformations, frames and residuals are converted to dtype.
+    :param refine_iterations: number of iterations that are done in the precision of the snapshot matrix after
+                              the iterations in dtype have stopped (or Niter - refine_iterations iterations are done)
+    :param initial_frames: frames which are used as initial guess (e.g. see project_frames). They are updated in place.
     :return:
     """
 
@@ -393,11 +767,24 @@ def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = Fa
     ## 1.Step: Initialize
     #########################
     q = snapshot_matrix
+    transforms_refine = transforms
+    refine = dtype is not None and refine_iterations > 0
+    if dtype is not None:
+        q = q.astype(dtype)
+        transforms = [trafo.astype(dtype) for trafo in transforms]
     qtilde = np.zeros_like(q)
     Nframes = len(transforms)
     if np.size(nmodes) != Nframes:
         nmodes = list([nmodes]) * Nframes
-    qtilde_frames = [frame(trafo, qtilde, number_of_modes=nmodes[k]) for k,trafo in enumerate(transforms)]
+    if initial_frames is None:
+        qtilde_frames = [frame(trafo, qtilde, number_of_modes=nmodes[k]) for k,trafo in enumerate(transforms)]
+    else:
+        qtilde_frames = initial_frames
+        for k, (trafo, q_frame) in enumerate(zip(transforms, qtilde_frames)):
+            q_frame.trafo = trafo
+            q_frame.Nmodes = nmodes[k]
+            q_frame.astype(q.dtype)
+            qtilde += q_frame.lab_field()
     norm_q = norm(reshape(q,-1))
 
     ###########################
@@ -414,6 +801,42 @@ def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = Fa
     print("rel-error using svd with %d modes:%4.4e"%(r_,err_svd))
     ###########################
 
+    def frame_step(k):
+        # the SVD input of frame k is q^k + D^k
+        D = float(steps[k]) * transforms[k].reverse(res_eval)
+        if acceleration == "nesterov":
+            D += beta * (fields[k] - fields_old[k])
+        return D
+
+    def update_frame(k):
+        q_frame = qtilde_frames[k]
+        if use_lowrank_update:
+            q_frame.update(D_list[k], 1)
+        else:
+            q_frame.set_orthonormal_system(fields[k] + D_list[k], use_rSVD, use_warmstart)
+        if total_variation_iterations > 0:
+            q_frame.smoothen_time_amplitudes(TV_iterations=total_variation_iterations)
+        return q_frame.lab_field()
+
+    if n_workers is None or n_workers < 1:
+        n_workers = os.cpu_count()
+    frame_pool = ThreadPoolExecutor(max_workers=min(n_workers, Nframes))
+
+    steps = np.ones(Nframes) / Nframes  # step size of each frame
+    # the dense fields of the frames are only needed by the dense SVD and the accelerations,
+    # the low rank update works on the modal systems only
+    use_fields = not use_lowrank_update or acceleration is not None
+    fields = [q_frame.field() for q_frame in qtilde_frames] if use_fields else None
+    if acceleration == "nesterov":
+        t_momentum = 1
+        fields_old = fields
+        qtilde_old = qtilde.copy()
+    elif acceleration == "anderson":
+        mixer = anderson_acceleration(anderson_depth)
+        x_old = fields
+    elif acceleration is not None:
+        raise ValueError("acceleration %s not known" % acceleration)
+
     it = 0
     rel_err = 1
     rel_err_list = []
@@ -427,28 +850,120 @@ def shifted_POD(snapshot_matrix, transforms, nmodes, eps, Niter=1, use_rSVD = Fa
         norm_res = norm(reshape(res,-1))
         rel_err = norm_res/norm_q
         rel_err_list.append(rel_err)
-        qtilde = np.zeros_like(q)
+        res_eval = res
 
         ###########################
         # 3. Step: update frames
         ##########################
         t = time.time()
-        for k, (trafo,q_frame) in enumerate(zip(transforms,qtilde_frames)):
-            #R_frame = frame(trafo, res, number_of_modes=nmodes)
-            res_shifted = trafo.reverse(res)
-            q_frame_field = q_frame.build_field()
-            q_frame.set_orthonormal_system(q_frame_field + res_shifted/Nframes, use_rSVD)
-            if total_variation_iterations > 0:
-                q_frame.smoothen_time_amplitudes(TV_iterations=total_variation_iterations)
-            qtilde += trafo.apply(q_frame.build_field())
+        # restart the acceleration if the error increases
+        restart = len(rel_err_list) > 1 and rel_err_list[-1] > rel_err_list[-2]
+        if use_fields:
+            fields = [q_frame.field() for q_frame in qtilde_frames]
+        if acceleration == "nesterov":
+            if restart:
+                t_momentum = 1
+            t_new = (1 + np.sqrt(1 + 4 * t_momentum ** 2)) / 2
+            beta = float((t_momentum - 1) / t_new)
+            t_momentum = t_new
+            # residual at the extrapolated point q^k + beta * (q^k - q^k_old) of all frames
+            res_eval = res - beta * (qtilde - qtilde_old)
+        # the frames only share the (read only) residual and can be updated concurrently
+        D_list = list(frame_pool.map(frame_step, range(Nframes)))
+        if acceleration == "anderson":
+            if restart:
+                mixer.reset()
+            G = [field + D for field, D in zip(fields, D_list)]
+            x = mixer.mix(G, [g - x_k for g, x_k in zip(G, x_old)])
+            D_list = [x_k - field for x_k, field in zip(x, fields)]
+            x_old = x
+        if adaptive_step:
+            qframes_lab_old = [q_frame.lab_field() for q_frame in qtilde_frames]
+        qframes_lab = list(frame_pool.map(update_frame, range(Nframes)))
+        if acceleration == "nesterov":
+            fields_old = fields
+            qtilde_old[...] = qtilde
+        qtilde[...] = 0  # reuse the buffer, the frames are accumulated in place
+        for qframe_lab in qframes_lab:
+            qtilde += qframe_lab
+        if adaptive_step:
+            # rescale the step of every frame by the factor that best reduces the residual with the update
+            dqframes_lab = [lab - lab_old for lab, lab_old in zip(qframes_lab, qframes_lab_old)]
+            A = np.asarray([[np.vdot(a, b) for b in dqframes_lab] for a in dqframes_lab])
+            b = np.asarray([np.vdot(a, res) for a in dqframes_lab])
+            gamma = lstsq(A, b, rcond=None)[0]
+            steps = np.clip(steps * gamma, 0.1 / Nframes, 1)
         elapsed = time.time() - t
         print("it=%d rel_err= %4.4e t_cpu = %2.2f" % (it, rel_err, elapsed))
-        if it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1]):
+        converged = it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1])
+        if refine and (converged or rel_err <= eps or it >= Niter - refine_iterations):
+            # refinement: continue in the precision of the snapshot matrix
+            print("refinement with %d iterations in %s" % (refine_iterations, snapshot_matrix.dtype))
+            refine = False
+            q = snapshot_matrix
+            transforms = transforms_refine
+            for trafo, q_frame in zip(transforms, qtilde_frames):
+                q_frame.trafo = trafo
+                q_frame.astype(q.dtype)
+            qtilde = np.sum([q_frame.lab_field() for q_frame in qtilde_frames], axis=0)
+            Niter = it + refine_iterations
+            rel_err = 1
+            # restart the acceleration
+            if acceleration == "nesterov":
+                t_momentum = 1
+                qtilde_old = qtilde.copy()
+            elif acceleration == "anderson":
+                mixer.reset()
+                x_old = [q_frame.field() for q_frame in qtilde_frames]
+        elif converged:
             break
 
+    frame_pool.shutdown()
 
     return ReturnValue(qtilde_frames, qtilde, rel_err_list)
 
+class anderson_acceleration:
+    """
+    Anderson acceleration (type II) of the fixed point iteration x = G(x), where the iterates x are lists of
+    arrays (one for each frame). Besides the last depth+1 values of G(x) and f = G(x) - x only
+    the Gram matrix of the f's is stored.
+    """
+    def __init__(self, depth = 3):
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        self.G_hist = []
+        self.F_hist = []
+        self.gram = np.zeros([0, 0])
+
+    def mix(self, G, F):
+        """
+        Returns the next iterate x = G - sum_i gamma_i (G_(i+1) - G_i), where gamma minimizes
+        || F - sum_i gamma_i (F_(i+1) - F_i) ||
+        """
+        if len(self.F_hist) == self.depth + 1:
+            self.G_hist.pop(0)
+            self.F_hist.pop(0)
+            self.gram = self.gram[1:, 1:]
+        self.G_hist.append(G)
+        self.F_hist.append(F)
+        row = np.asarray([sum(np.vdot(a, b) for a, b in zip(F_j, F)) for F_j in self.F_hist])
+        m = len(row)
+        gram = np.zeros([m, m])
+        gram[:-1, :-1] = self.gram
+        gram[-1, :] = row
+        gram[:, -1] = row
+        self.gram = gram
+        if m == 1:
+            return G
+        # rows of Diff are the differences e_(i+1) - e_i
+        Diff = np.diff(np.eye(m), axis=0)
+        gamma = lstsq(Diff @ gram @ Diff.T, Diff @ gram[:, -1], rcond=None)[0]
+        c = -Diff.T @ gamma
+        c[-1] += 1
+        return [sum(float(c[j]) * self.G_hist[j][k] for j in range(m)) for k in range(len(G))]
+
 def force_constraint(qframes, transforms, q, Niter = 1, alphas = None):
     """ this function enfroces the constraint Q = sum_k T^k Q^k"""
     norm_q = norm(reshape(q, -1))
@@ -458,20 +973,26 @@ def force_constraint(qframes, transforms, q, Niter = 1, alphas = None):
         alphas = [1/Nframes]*Nframes
 
     for iter in range(Niter):
-        qtilde = 0
+        qtilde[...] = 0
         for k, (trafo, q_frame) in enumerate(zip(transforms, qframes)):
 
-            qtilde += trafo.apply(q_frame.build_field())
+            if trafo is q_frame.trafo:
+                qtilde += q_frame.lab_field()
+            else:
+                trafo.apply(q_frame.field(), out=qtilde, accumulate=True)
             q_frame.Nmodes = -1
 
         res = q - qtilde
-        qtilde = 0
+        qtilde[...] = 0
         for k, (trafo, q_frame) in enumerate(zip(transforms, qframes)):
 
             res_shifted = trafo.reverse(res)
-            q_frame_field = q_frame.build_field()
+            q_frame_field = q_frame.field()
             q_frame.set_orthonormal_system(q_frame_field + res_shifted * alphas[k], use_rSVD=False)
-            qtilde += trafo.apply(q_frame.build_field())
+            if trafo is q_frame.trafo:
+                qtilde += q_frame.lab_field()
+            else:
+                trafo.apply(q_frame.field(), out=qtilde, accumulate=True)
 
     res = q - qtilde
     norm_res = norm(reshape(res, -1))
@@ -580,7 +1101,9 @@ def give_interpolation_error(snapshot_data, trafo):
 ###############################################################################
 # shifted rPCA
 ###############################################################################
-def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=1, use_rSVD= False, visualize=True, mu = None, lambd = None, dtol=1e-13):
+def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=1, use_rSVD= False, visualize=True, mu = None, lambd = None, dtol=1e-13,
+                 use_adaptive_SVT = False, mu_update = "fixed", rho = 1.05, mu_max = None, primal_tol = None, dual_tol = None,
+                 dtype = None, refine_iterations = 0):
     """
     :param snapshot_matrix: M x N matrix with N beeing the number of snapshots, M is the ODE dimension
     :param transforms: Transformations
@@ -590,6 +1113,20 @@ def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=
     :param eps: stopping criteria
     :param Niter: maximal number of iterations
     :param visualize: if true: show intermediet results
+    :param use_adaptive_SVT: if true: the SVT computes only a few more singular values than the rank of the frame
+                             in the last iteration (see SVT)
+    :param mu_update: penalty schedule of the augmented Lagrangian
+                      "fixed": mu is kept at its initial value
+                      "geometric": inexact ALM, mu is increased by the factor rho in every iteration
+                      "balance": mu is increased (decreased) by rho if the primal residual is 10 times larger (smaller)
+                                 than the dual residual
+    :param rho: growth factor of mu
+    :param mu_max: upper bound of mu, default is 1e7 times the initial mu
+    :param primal_tol: stops if the primal residual ||q - qtilde - E||/||q|| is below primal_tol (and the dual residual below dual_tol)
+    :param dual_tol: stops if the dual residual mu*||E - E_old||/||q|| is below dual_tol (and the primal residual below primal_tol)
+    :param dtype: floating point type of the computation (see shifted_POD)
+    :param refine_iterations: number of iterations that are done in the precision of the snapshot matrix after
+                              the iterations in dtype have stopped (or Niter - refine_iterations iterations are done)
     :return:
     """
     assert (np.ndim(snapshot_matrix) == 2), "Are you stephen hawking, trying to solve this problem in 16 dimensions?" \
@@ -599,6 +1136,11 @@ def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=
     #########################
     ## 1.Step: Initialize
     #########################
+    snapshot_refine, transforms_refine = snapshot_matrix, transforms
+    refine = dtype is not None and refine_iterations > 0
+    if dtype is not None:
+        snapshot_matrix = snapshot_matrix.astype(dtype)
+        transforms = [trafo.astype(dtype) for trafo in transforms]
     qtilde = np.zeros_like(snapshot_matrix)
     E = np.zeros_like(snapshot_matrix)
     Nframes = len(transforms)
@@ -623,18 +1165,25 @@ def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=
         mu = N * M / (4 * np.sum(np.abs(q)))
     if lambd is None:
         lambd =  1 / np.sqrt(np.maximum(M, N))
+    mu, lambd = float(mu), float(lambd) # python floats keep the precision of the arrays
+    if mu_max is None:
+        mu_max = 1e7 * mu
+    if mu_update not in ["fixed", "geometric", "balance"]:
+        raise ValueError("mu_update %s not known" % mu_update)
     thresh = 1e-7 * norm_q
     mu_inv = 1 / mu
     rel_err = 1
-    res_old = 0
     rel_err_list = []
+    mu_hist = []
     ranks_hist = [[] for r in range(Nframes)]
+    # lab frame contributions T^k q^k of all frames and their running sum qtilde
+    qframes_lab = [trafo.apply(q_frame.build_field()) for trafo, q_frame in zip(transforms, qtilde_frames)]
+    qtilde = np.sum(qframes_lab, axis=0)
     while rel_err > eps and it < Niter:
         it += 1  # counts the number of iterations in the loop
         #############################
-        # 2.Step: set qtilde to 0
+        # 2.Step: qtilde is updated frame by frame
         #############################
-        qtilde = np.zeros_like(q)
         ranks = []
         ###########################
         # 3. Step: update frames
@@ -642,21 +1191,27 @@ def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=
         t = time.time()
 
         for k, (trafo, q_frame) in enumerate(zip(transforms, qtilde_frames)):
-            qtemp = 0
-            for p, (trafo_p, frame_p) in enumerate(zip(transforms, qtilde_frames)):
-                if p != k:
-                    qtemp += trafo_p.apply(frame_p.build_field())
-            qk = trafo.reverse(q - qtemp - E + mu_inv * Y)
+            # sum of all other frames: qtilde - T^k q^k
+            qtilde -= qframes_lab[k]
+            qk = trafo.reverse(q - qtilde - E + mu_inv * Y)
             #qk = trafo.reverse(q - qfield_list[k] - E + mu_inv * Y)
-            [U, S, VT] = SVT(qk, mu_inv, q_frame.Nmodes, use_rSVD)
+            # the randomized SVDs of the frame draw their seed from the generator of the frame
+            random_state = int(q_frame.rng.integers(2**31))
+            if use_adaptive_SVT:
+                rank_guess = ranks_hist[k][-1] if ranks_hist[k] else 0
+                [U, S, VT] = SVT(qk, mu_inv, q_frame.Nmodes, use_rSVD, rank_guess, random_state=random_state)
+            else:
+                [U, S, VT] = SVT(qk, mu_inv, q_frame.Nmodes, use_rSVD, random_state=random_state)
             rank = np.sum(S > 0)
             q_frame.modal_system = {"U": U[:,:rank], "sigma": S[:rank], "VT": VT[:rank,:]}
             ranks.append(rank) # list of ranks for each frame
             ranks_hist[k].append(rank)
-            qtilde += trafo.apply(q_frame.build_field())
+            trafo.apply(q_frame.build_field(), out=qframes_lab[k])
+            qtilde += qframes_lab[k]
         ###########################
         # 4. Step: update noice term
         ##########################
+        E_old = E
         E = shrink(q - qtilde + mu_inv * Y, lambd * mu_inv)
         #############################
         # 5. Step: update multiplier
@@ -667,32 +1222,561 @@ def shifted_rPCA(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=
         #############################
         # 6. Step: update mu
         #############################
-        dres = norm(res,ord='fro') - res_old
-        res_old =  norm(res,ord='fro')
-        norm_dres = np.abs(dres)
-
         norm_res = norm(reshape(res, -1))
         rel_err_without_noise =  norm(reshape(res+E, -1))/norm_q
-        rel_err = norm_res / norm_q
+        rel_err = norm_res / norm_q  # primal residual
+        dual_err = mu * norm(reshape(E - E_old, -1)) / norm_q  # dual residual
         rel_err_list.append(rel_err)
+        mu_hist.append(mu)
         elapsed = time.time() - t
-        print("it=%d rel_err= %4.1e norm(dres) = %4.1e norm(Q-Qtilde)/norm(q) =%4.1e norm(E)/norm(q) = %4.1e tcpu = %2.2f, ranks_frame = " % (
-        it, rel_err, mu*norm_dres/norm_q,rel_err_without_noise, norm(reshape(E, -1))/norm_q, elapsed), *ranks)
-
-        if it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1]):
+        print("it=%d rel_err= %4.1e dual_err = %4.1e norm(Q-Qtilde)/norm(q) =%4.1e norm(E)/norm(q) = %4.1e mu = %4.1e tcpu = %2.2f, ranks_frame = " % (
+        it, rel_err, dual_err, rel_err_without_noise, norm(reshape(E, -1))/norm_q, mu, elapsed), *ranks)
+
+        if mu_update == "geometric":
+            mu = min(rho * mu, mu_max)
+        elif mu_update == "balance":
+            if rel_err > 10 * dual_err:
+                mu = min(rho * mu, mu_max)
+            elif dual_err > 10 * rel_err:
+                mu = mu / rho
+        mu_inv = 1 / mu
+
+        converged = it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1])
+        if (primal_tol is not None or dual_tol is not None) \
+                and (primal_tol is None or rel_err < primal_tol) and (dual_tol is None or dual_err < dual_tol):
+            converged = True
+        if refine and (converged or rel_err <= eps or it >= Niter - refine_iterations):
+            # refinement: continue in the precision of the snapshot matrix
+            print("refinement with %d iterations in %s" % (refine_iterations, snapshot_refine.dtype))
+            refine = False
+            q = snapshot_refine.copy()
+            transforms = transforms_refine
+            for trafo, q_frame in zip(transforms, qtilde_frames):
+                q_frame.trafo = trafo
+                q_frame.astype(q.dtype)
+            qframes_lab = [trafo.apply(q_frame.field()) for trafo, q_frame in zip(transforms, qtilde_frames)]
+            qtilde = np.sum(qframes_lab, axis=0)
+            E, Y = E.astype(q.dtype), Y.astype(q.dtype)
+            norm_q = norm(reshape(q, -1))
+            Niter = it + refine_iterations
+            rel_err = 1
+        elif converged:
             break
 
-        ranks_hist.append(ranks)
-
-    qtilde = 0
+    qtilde[...] = 0
     for p, (trafo_p, frame_p) in enumerate(zip(transforms, qtilde_frames)):
-            qtilde += trafo_p.apply(frame_p.build_field())
+            qtilde += frame_p.lab_field()
             S =frame_p.modal_system["sigma"]
             frame_p.Nmodes = np.sum(S > 0)
 
-    return ReturnValue(qtilde_frames, qtilde, rel_err_list, E, ranks, np.asarray(ranks_hist))
+    return ReturnValue(qtilde_frames, qtilde, rel_err_list, E, ranks, np.asarray(ranks_hist), np.asarray(mu_hist))
+
+
+
+###############################################################################
+# out of core sPOD
+###############################################################################
+
+def time_blocks(Ntime, block_size):
+    """ Returns the list of slices of the column blocks [0, block_size), [block_size, 2*block_size), ... """
+    return [slice(t_start, min(t_start + block_size, Ntime)) for t_start in range(0, Ntime, block_size)]
 
+def blockwise_svd(compute_blocks, Ntime, ranks, block_size, VT0 = None, n_iter = 1, n_oversamples = 5, rng = None):
+    """
+    Randomized truncated SVDs of the M x Ntime matrices X_1, ..., X_K, which are only available in column blocks:
+        [X_1[:, ts], ..., X_K[:, ts]] = compute_blocks(ts, sweep)
+    where sweep counts the passes over all blocks. Every pass computes each block once and only
+    M x (rank + n_oversamples) and Ntime x (rank + n_oversamples) arrays are kept in memory.
+    The number of passes is 2 + 2 * n_iter.
+
+    :param ranks: list of the number of singular values of every matrix
+    :param VT0: list of right singular vectors of nearby matrices (e.g. from the last iteration), used as starting blocks
+    :param rng: list of random generators of every matrix (e.g. frame.rng), default: numpy.random
+    :return: list of (U, S, VT)
+    """
+    blocks = time_blocks(Ntime, block_size)
+    Nmat = len(ranks)
+    sweep = 0
+
+    def multiply(Z):
+        # Y_k = X_k @ Z_k
+        nonlocal sweep
+        Y = [0] * Nmat
+        for ts in blocks:
+            for k, X in enumerate(compute_blocks(ts, sweep)):
+                Y[k] = Y[k] + X @ Z[k][ts]
+        sweep += 1
+        return Y
+
+    def multiply_transposed(Q):
+        # Z_k = X_k^T @ Q_k
+        nonlocal sweep
+        Z = [np.zeros([Ntime, np.shape(Q_k)[1]]) for Q_k in Q]
+        for ts in blocks:
+            for k, X in enumerate(compute_blocks(ts, sweep)):
+                Z[k][ts] = X.T @ Q[k]
+        sweep += 1
+        return Z
+
+    rng = [np.random] * Nmat if rng is None else rng
+    Omega = [rng_k.standard_normal((Ntime, min(r + n_oversamples, Ntime))) for rng_k, r in zip(rng, ranks)]
+    if VT0 is not None:
+        for k, VT in enumerate(VT0):
+            n0 = min(np.shape(VT)[0], np.shape(Omega[k])[1])
+            Omega[k][:, :n0] = VT[:n0, :].T
+    Y = multiply(Omega)
+    for i in range(n_iter):
+        Z = multiply_transposed([qr(Y_k)[0] for Y_k in Y])
+        Y = multiply([qr(Z_k)[0] for Z_k in Z])
+    Q = [qr(Y_k)[0] for Y_k in Y]
+    # svd of the small matrices B_k = Q_k^T X_k
+    BT = multiply_transposed(Q)
+    svds = []
+    for k, r in enumerate(ranks):
+        [Ub, S, VT] = svd(BT[k].T, full_matrices=False)
+        svds.append((Q[k] @ Ub[:, :r], S[:r], VT[:r, :]))
+    return svds
+
+def open_work_array(work_dir, name, shape, dtype):
+    """ Creates a zero initialized memory mapped array name.npy in work_dir with contiguous columns """
+    return np.lib.format.open_memmap(os.path.join(work_dir, name + ".npy"), mode="w+", dtype=dtype,
+                                     shape=tuple(shape), fortran_order=True)
+
+def empty_frame(trafo, number_of_modes):
+    """ Returns a frame of rank 0 """
+    q_frame = frame(trafo, number_of_modes=number_of_modes)
+    M, N = np.prod(trafo.data_shape[:3]), trafo.data_shape[3]
+    q_frame.modal_system = {"U": np.zeros([M, 0]), "sigma": np.zeros(0), "VT": np.zeros([0, N])}
+    return q_frame
+
+def shifted_POD_out_of_core(snapshot_matrix, transforms, nmodes, eps, Niter=1, dtol = 1e-7, block_size = 100,
+                            work_dir = None, n_iter_svd = 1):
+    """
+    Out of core version of shifted_POD for snapshot matrices which do not fit into memory (e.g. numpy.memmap).
+    The snapshot matrix is processed in column blocks of block_size time snapshots. qtilde and the residual
+    are never stored, since they are computed block by block from the low rank frames.
+    The SVDs of the frames are computed with randomized range finding over the blocks (see blockwise_svd).
+    For fast access to the column blocks the snapshot matrix should be stored in fortran order.
+
+    :param work_dir: directory for the memory mapped approximation of the snapshot matrix (default: temporary directory)
+    :param n_iter_svd: number of power iterations of the blockwise SVD
+    :return: ReturnValue, where the approximation is a numpy.memmap in work_dir
+    """
+    q = snapshot_matrix
+    M, N = np.shape(q)
+    Nframes = len(transforms)
+    if np.size(nmodes) != Nframes:
+        nmodes = list([nmodes]) * Nframes
+    qtilde_frames = [empty_frame(trafo, nmodes[k]) for k, trafo in enumerate(transforms)]
+    norm_q = np.sqrt(sum(norm(np.asarray(q[:, ts]))**2 for ts in time_blocks(N, block_size)))
+
+    def frame_blocks(ts):
+        # dense fields of all frames in the columns ts
+        return [np.dot(q_frame.modal_system["U"] * q_frame.modal_system["sigma"], q_frame.modal_system["VT"][:, ts])
+                for q_frame in qtilde_frames]
+
+    def compute_blocks(ts, sweep):
+        # input of the SVDs: q^k + T^(-k)(q - qtilde)/Nframes
+        trafos = [trafo.select_time(ts) for trafo in transforms]
+        fields = frame_blocks(ts)
+        res = np.array(q[:, ts])
+        for trafo, field in zip(trafos, fields):
+            res -= trafo.apply(field)
+        if sweep == 0:
+            norm_res2[0] += norm(res)**2
+        return [field + trafo.reverse(res) / Nframes for trafo, field in zip(trafos, fields)]
 
+    it = 0
+    rel_err = 1
+    rel_err_list = []
+    while rel_err > eps and it < Niter:
+        it += 1  # counts the number of iterations in the loop
+        t = time.time()
+        norm_res2 = [0]
+        svds = blockwise_svd(compute_blocks, N, nmodes, block_size,
+                             [q_frame.modal_system["VT"] for q_frame in qtilde_frames], n_iter_svd,
+                             rng=[q_frame.rng for q_frame in qtilde_frames])
+        for q_frame, (U, S, VT) in zip(qtilde_frames, svds):
+            q_frame.modal_system = {"U": U, "sigma": S, "VT": VT}
+        rel_err = np.sqrt(norm_res2[0]) / norm_q
+        rel_err_list.append(rel_err)
+        elapsed = time.time() - t
+        print("it=%d rel_err= %4.4e t_cpu = %2.2f" % (it, rel_err, elapsed))
+        if it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1]):
+            break
+
+    # approximation qtilde = sum_k T^k q^k
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    qtilde = open_work_array(work_dir, "qtilde", [M, N], q.dtype)
+    for ts in time_blocks(N, block_size):
+        qtilde[:, ts] = sum(trafo.select_time(ts).apply(field) for trafo, field in zip(transforms, frame_blocks(ts)))
+    qtilde.flush()
+
+    return ReturnValue(qtilde_frames, qtilde, rel_err_list)
+
+def shifted_rPCA_out_of_core(snapshot_matrix, transforms, nmodes_max=None, eps=1e-16, Niter=1, mu = None, lambd = None,
+                             dtol=1e-13, block_size = 100, work_dir = None, n_iter_svd = 1, mu_update = "fixed",
+                             rho = 1.05, mu_max = None, primal_tol = None, dual_tol = None):
+    """
+    Out of core version of shifted_rPCA for snapshot matrices which do not fit into memory (e.g. numpy.memmap).
+    qtilde, the noise E and the multiplier Y are memory mapped arrays in work_dir and all arrays are processed in
+    column blocks of block_size time snapshots. The singular value thresholding uses the blockwise SVD
+    with an adaptive number of singular values (see SVT and blockwise_svd).
+    For fast access to the column blocks the snapshot matrix should be stored in fortran order.
+
+    :param work_dir: directory for the memory mapped arrays (default: temporary directory)
+    :param n_iter_svd: number of power iterations of the blockwise SVD
+    :param mu_update, rho, mu_max, primal_tol, dual_tol: penalty schedule and stopping criteria (see shifted_rPCA)
+    :return: ReturnValue, where the approximation and E are numpy.memmaps in work_dir
+    """
+    q = snapshot_matrix
+    M, N = np.shape(q)
+    Nframes = len(transforms)
+    blocks = time_blocks(N, block_size)
+    if not np.all(nmodes_max):
+        nmodes_max = np.max(np.shape(snapshot_matrix))
+    if np.size(nmodes_max) != Nframes:
+        nmodes = list([nmodes_max]) * Nframes
+    else:
+        nmodes = list(nmodes_max)
+    qtilde_frames = [empty_frame(trafo, nmodes[k]) for k, trafo in enumerate(transforms)]
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    qtilde = open_work_array(work_dir, "qtilde", [M, N], q.dtype)
+    E = open_work_array(work_dir, "E", [M, N], q.dtype)
+    Y = open_work_array(work_dir, "Y", [M, N], q.dtype)
+
+    norm_q = np.sqrt(sum(norm(np.asarray(q[:, ts]))**2 for ts in blocks))
+    if mu is None:
+        mu = N * M / (4 * sum(np.sum(np.abs(q[:, ts])) for ts in blocks))
+    if lambd is None:
+        lambd =  1 / np.sqrt(np.maximum(M, N))
+    mu, lambd = float(mu), float(lambd)
+    if mu_max is None:
+        mu_max = 1e7 * mu
+    if mu_update not in ["fixed", "geometric", "balance"]:
+        raise ValueError("mu_update %s not known" % mu_update)
+    mu_inv = 1 / mu
+
+    def frame_block(q_frame, ts):
+        return np.dot(q_frame.modal_system["U"] * q_frame.modal_system["sigma"], q_frame.modal_system["VT"][:, ts])
+
+    it = 0
+    rel_err = 1
+    rel_err_list = []
+    mu_hist = []
+    ranks_hist = [[] for r in range(Nframes)]
+    while rel_err > eps and it < Niter:
+        it += 1  # counts the number of iterations in the loop
+        t = time.time()
+        ranks = []
+        ###########################
+        # update frames
+        ##########################
+        for k, (trafo, q_frame) in enumerate(zip(transforms, qtilde_frames)):
+
+            def compute_blocks(ts, sweep):
+                # T^(-k)(q - sum_(p!=k) T^p q^p - E + Y/mu)
+                trafo_ts = trafo.select_time(ts)
+                qtemp = qtilde[:, ts] - trafo_ts.apply(frame_block(q_frame, ts))
+                return [trafo_ts.reverse(q[:, ts] - qtemp - E[:, ts] + mu_inv * Y[:, ts])]
+
+            # singular value thresholding with adaptive number of singular values
+            nmax = min(M, N, q_frame.Nmodes)
+            Nsigma = min((ranks_hist[k][-1] if ranks_hist[k] else 0) + 5, nmax)
+            while True:
+                [(U, S, VT)] = blockwise_svd(compute_blocks, N, [Nsigma], block_size, [q_frame.modal_system["VT"]],
+                                             n_iter_svd, rng=[q_frame.rng])
+                if S[-1] <= mu_inv or Nsigma >= nmax:
+                    break
+                Nsigma = min(2 * Nsigma, nmax)
+            S = shrink(S, mu_inv)
+            rank = np.sum(S > 0)
+            frame_old = {"U": q_frame.modal_system["U"], "sigma": q_frame.modal_system["sigma"],
+                         "VT": q_frame.modal_system["VT"]}
+            q_frame.modal_system = {"U": U[:, :rank], "sigma": S[:rank], "VT": VT[:rank, :]}
+            ranks.append(rank)
+            ranks_hist[k].append(rank)
+            # replace the old contribution of the frame in qtilde
+            for ts in blocks:
+                trafo_ts = trafo.select_time(ts)
+                qtilde[:, ts] += trafo_ts.apply(frame_block(q_frame, ts)) \
+                                 - trafo_ts.apply(np.dot(frame_old["U"] * frame_old["sigma"], frame_old["VT"][:, ts]))
+        ###########################
+        # update noise term and multiplier
+        ##########################
+        norm_res2, norm_dual2 = 0, 0
+        for ts in blocks:
+            q_ts, qtilde_ts, E_old = np.asarray(q[:, ts]), np.asarray(qtilde[:, ts]), np.array(E[:, ts])
+            E[:, ts] = shrink(q_ts - qtilde_ts + mu_inv * Y[:, ts], lambd * mu_inv)
+            res = q_ts - qtilde_ts - E[:, ts]
+            Y[:, ts] += mu * res
+            norm_res2 += norm(res)**2
+            norm_dual2 += norm(E[:, ts] - E_old)**2
+        rel_err = np.sqrt(norm_res2) / norm_q
+        dual_err = mu * np.sqrt(norm_dual2) / norm_q
+        rel_err_list.append(rel_err)
+        mu_hist.append(mu)
+        elapsed = time.time() - t
+        print("it=%d rel_err= %4.1e dual_err = %4.1e mu = %4.1e tcpu = %2.2f, ranks_frame = " % (
+            it, rel_err, dual_err, mu, elapsed), *ranks)
+
+        if mu_update == "geometric":
+            mu = min(rho * mu, mu_max)
+        elif mu_update == "balance":
+            if rel_err > 10 * dual_err:
+                mu = min(rho * mu, mu_max)
+            elif dual_err > 10 * rel_err:
+                mu = mu / rho
+        mu_inv = 1 / mu
+
+        if it> 5 and np.abs(rel_err_list[-1]-rel_err_list[-4])<dtol*abs(rel_err_list[-1]):
+            break
+        if (primal_tol is not None or dual_tol is not None) \
+                and (primal_tol is None or rel_err < primal_tol) and (dual_tol is None or dual_err < dual_tol):
+            break
+
+    for q_frame in qtilde_frames:
+        q_frame.Nmodes = np.sum(q_frame.modal_system["sigma"] > 0)
+    for array in [qtilde, E, Y]:
+        array.flush()
+
+    return ReturnValue(qtilde_frames, qtilde, rel_err_list, E, ranks, np.asarray(ranks_hist), np.asarray(mu_hist))
+
+###############################################################################
+# online sPOD
+###############################################################################
+
+class online_shifted_POD:
+    """
+    Streaming version of shifted_POD, which decomposes the snapshots batch by batch while they are produced:
+
+        sPOD = online_shifted_POD(nmodes)
+        for snapshots, trafos in simulation:
+            sPOD.add_snapshots(snapshots, trafos)
+        qtilde = build_all_frames(sPOD.frames, sPOD.full_transforms())
+
+    The frames are extended with the new time steps and a few residual distribution sweeps
+    (see shifted_POD) are done over the new snapshots and the last n_memory old snapshots.
+    The frames are updated with Brand's incremental SVD (see frame.update_columns), such that
+    all older snapshots are not needed. Likewise only the transformations of the active window
+    (new snapshots and memory) are kept, together with the shifts and rotations of all time steps.
+    """
+
+    def __init__(self, nmodes, n_sweeps = 3, n_memory = 0):
+        """
+        :param nmodes: number of modes allowed in each frame
+        :param n_sweeps: number of residual distribution sweeps for every batch of snapshots
+        :param n_memory: number of old snapshots, which are kept to correct their approximation in the next sweeps
+        """
+        self.nmodes = nmodes
+        self.n_sweeps = n_sweeps
+        self.n_memory = n_memory
+        self.frames = None
+        self.transforms = None  # transformations of the active window
+        self.trafo_params = None  # shifts and rotations of every batch for each frame
+        self.memory = None  # the last n_memory snapshots
+        self.rel_err_hist = []  # relative error of every batch after the sweeps
+
+    def add_snapshots(self, snapshots, transforms):
+        """
+        Adds a batch of snapshots to the decomposition.
+
+        :param snapshots: M x Nbatch matrix of the new snapshots
+        :param transforms: list of the transformations of every frame for the time steps of the new snapshots
+        :return: relative error of the new snapshots
+        """
+        Nframes = len(transforms)
+        Nbatch = np.shape(snapshots)[1]
+        if self.frames is None:
+            nmodes = self.nmodes if np.size(self.nmodes) == Nframes else list([self.nmodes]) * Nframes
+            self.frames = [empty_frame(trafo, nmodes[k]) for k, trafo in enumerate(transforms)]
+            self.transforms = list(transforms)
+            self.trafo_params = [[] for trafo in transforms]
+        else:
+            # the operators of the old time steps are only kept for the snapshots in memory
+            Nkeep = 0 if self.memory is None else np.shape(self.memory)[1]
+            self.transforms = [trafo.select_time(slice(trafo.Ntime - Nkeep, trafo.Ntime)).append_time(trafo_new)
+                               for trafo, trafo_new in zip(self.transforms, transforms)]
+            for q_frame in self.frames:
+                # the transformations of all time steps are set up by full_transforms
+                q_frame.trafo = None
+                q_frame.extend_time(Nbatch)
+        for params, trafo in zip(self.trafo_params, transforms):
+            params.append((trafo.shifts, getattr(trafo, "rotations", None)))
+        # the sweeps act on the new snapshots and the snapshots in memory
+        q = snapshots if self.memory is None else np.concatenate([self.memory, snapshots], axis=1)
+        Ntime = self.frames[0].Ntime
+        ts = slice(Ntime - np.shape(q)[1], Ntime)
+        transforms = self.transforms
+        if self.n_memory > 0:
+            self.memory = q[:, -self.n_memory:]
+
+        norm_q = norm(snapshots)
+        for sweep in range(self.n_sweeps + 1):
+            fields = [np.dot(q_frame.modal_system["U"] * q_frame.modal_system["sigma"], q_frame.modal_system["VT"][:, ts])
+                      for q_frame in self.frames]
+            res = q - sum(trafo.apply(field) for trafo, field in zip(transforms, fields))
+            rel_err = norm(res[:, -Nbatch:]) / norm_q
+            if sweep == self.n_sweeps:
+                break
+            for trafo, q_frame, field in zip(transforms, self.frames, fields):
+                q_frame.update_columns(ts, field + trafo.reverse(res) / Nframes)
+        print("batch=%d rel_err= %4.4e" % (len(self.rel_err_hist) + 1, rel_err))
+        self.rel_err_hist.append(rel_err)
+        return rel_err
+
+    def full_transforms(self):
+        """
+        Returns the transformations of all time steps, which are set up again from the shifts and rotations
+        of all batches (see transforms.copy_with). They are also assigned to the frames.
+        """
+        trafos = []
+        for trafo, params, q_frame in zip(self.transforms, self.trafo_params, self.frames):
+            shifts, rotations = [None if params[0][i] is None else np.concatenate([p[i] for p in params], axis=-1)
+                                 for i in range(2)]
+            q_frame.trafo = trafo.copy_with(shifts, rotations)
+            trafos.append(q_frame.trafo)
+        return trafos
+
+
+# %%
+###############################################################################
+# windowed sPOD
+###############################################################################
+
+def time_windows(Ntime, window_size, overlap = 0):
+    """
+    Returns slices of window_size time steps, where neighboring windows share at least overlap time steps.
+    The last window ends at Ntime.
+    """
+    assert 0 <= overlap < window_size, "the overlap has to be smaller than the window size"
+    windows = []
+    start = 0
+    while start + window_size < Ntime:
+        windows.append(slice(start, start + window_size))
+        start += window_size - overlap
+    windows.append(slice(max(Ntime - window_size, 0), Ntime))
+    return windows
+
+def window_weights(windows, Ntime):
+    """
+    Returns the blending weights of the windows (Nwindows x Ntime), which are a partition of unity.
+    The weight of a window decays linearly towards its edges in the overlaps.
+    """
+    weights = np.zeros([len(windows), Ntime])
+    for w, ts in enumerate(windows):
+        t = np.arange(ts.start, ts.stop)
+        weights[w, ts] = np.minimum(t - ts.start + 1, ts.stop - t)
+    return weights / np.sum(weights, axis=0)
+
+def project_frames(q, transforms, frames):
+    """
+    Returns frames for the snapshots q, which are spanned by the modes of the given frames
+    (e.g. of a neighboring time window): the snapshots are distributed to the frames and
+    projected onto their modes. This is used as initial guess for shifted_POD.
+    """
+    Nframes = len(frames)
+    new_frames = []
+    for trafo, q_frame in zip(transforms, frames):
+        U = q_frame.modal_system["U"]
+        W, S, VT = svd(np.dot(U.T, trafo.reverse(q)) / Nframes, full_matrices=False)
+        new_frame = empty_frame(trafo, q_frame.Nmodes)
+        new_frame.modal_system = {"U": np.dot(U, W), "sigma": S, "VT": VT}
+        new_frames.append(new_frame)
+    return new_frames
+
+def align_frames(frames, frames_ref, ts = None, ts_ref = None):
+    """
+    Rotates the modes of the frames, such that they match the modes of the reference frames (orthogonal Procrustes).
+    This corrects sign flips, permutations and rotations in (nearly) degenerate subspaces of the modes.
+    If the time steps ts of the frames and ts_ref of the reference frames are the same (e.g. the overlap of
+    neighboring windows), the rotation W minimizes the difference of the modal coefficients
+    || W^T S VT[:, ts] - S_ref VT_ref[:, ts_ref] ||, otherwise it minimizes || U W - U_ref ||.
+    The frames keep U * S * VT, but with U W and the rows of W^T S VT, which are normalized
+    to VT and their norms to S. The modes are therefore no longer ordered by S.
+    """
+    for q_frame, q_frame_ref in zip(frames, frames_ref):
+        U, S, VT = q_frame.modal_system["U"], q_frame.modal_system["sigma"], q_frame.modal_system["VT"]
+        U_ref = q_frame_ref.modal_system["U"]
+        r = np.shape(U)[1]
+        if ts is None:
+            ref = U_ref.T
+            cur = U.T
+        else:
+            ref = q_frame_ref.modal_system["sigma"][:, None] * q_frame_ref.modal_system["VT"][:, ts_ref]
+            cur = S[:, None] * VT[:, ts]
+        # reference of every mode: the same number of modes with zeros for missing reference modes
+        ref_r = np.zeros([r, np.shape(ref)[1]])
+        ref_r[:min(r, np.shape(ref)[0])] = ref[:r]
+        # W = argmin || W^T cur - ref_r || over orthogonal W
+        P, _, QT = svd(np.dot(cur, ref_r.T))
+        W = np.dot(P, QT)
+        coeffs = np.dot(W.T, S[:, None] * VT)
+        S_new = norm(coeffs, axis=1)
+        VT_new = coeffs / np.where(S_new > 0, S_new, 1)[:, None]
+        q_frame.modal_system = {"U": np.dot(U, W), "sigma": S_new, "VT": VT_new}
+
+def shifted_POD_windowed(snapshot_matrix, transforms, nmodes, eps, window_size, overlap = 0, Niter=1,
+                         warm_start = True, n_workers = 1, **kwargs):
+    """
+    Windowed version of shifted_POD for long time series. The time axis is split into overlapping windows
+    (see time_windows) and shifted_POD is run on every window, such that the SVDs only involve window_size snapshots.
+    The windows are decomposed concurrently: first every second window and afterwards the remaining windows,
+    which are started from the modes of their left neighbor (see project_frames).
+    The modes of every window are aligned to its left neighbor and the window approximations are blended
+    in the overlaps (see window_weights).
+
+    :param window_size: number of time steps in each window
+    :param overlap: number of time steps, which are shared by neighboring windows
+    :param warm_start: if true: the windows with odd index are started from the modes of their left neighbor
+    :param n_workers: number of threads that decompose the windows concurrently (None or <1: number of cpus)
+    :param kwargs: further arguments of shifted_POD
+    :return: ReturnValue, where frames is a list with the frames of every window, rel_err_hist is a list with the
+             error history of every window and windows is the list of time slices of the windows
+    """
+    q = snapshot_matrix
+    M, N = np.shape(q)
+    windows = time_windows(N, window_size, overlap)
+    results = [None] * len(windows)
+
+    def decompose_window(w):
+        ts = windows[w]
+        trafos = [trafo.select_time(ts) for trafo in transforms]
+        initial_frames = None
+        if warm_start and w % 2 == 1:
+            initial_frames = project_frames(q[:, ts], trafos, results[w - 1].frames)
+        print("window=%d time steps %d:%d" % (w, ts.start, ts.stop))
+        results[w] = shifted_POD(q[:, ts], trafos, nmodes, eps, Niter, initial_frames=initial_frames, **kwargs)
+
+    if n_workers is None or n_workers < 1:
+        n_workers = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=n_workers) as window_pool:
+        list(window_pool.map(decompose_window, range(0, len(windows), 2)))
+        list(window_pool.map(decompose_window, range(1, len(windows), 2)))
+
+    # stitch the windows
+    weights = window_weights(windows, N)
+    qtilde = np.zeros_like(q, dtype=results[0].data_approx.dtype)
+    for w, (ts, result) in enumerate(zip(windows, results)):
+        if w > 0:
+            # align the modal coefficients in the time steps shared with the left neighbor (or the modes without overlap)
+            ts_prev = windows[w - 1]
+            shared = range(ts.start, min(ts.stop, ts_prev.stop))
+            if len(shared):
+                align_frames(result.frames, results[w - 1].frames,
+                             slice(shared.start - ts.start, shared.stop - ts.start),
+                             slice(shared.start - ts_prev.start, shared.stop - ts_prev.start))
+            else:
+                align_frames(result.frames, results[w - 1].frames)
+        qtilde[:, ts] += result.data_approx * weights[w, ts]
+    rel_err = norm(q - qtilde) / norm(q)
+    print("windows=%d rel_err= %4.4e" % (len(windows), rel_err))
+
+    return ReturnValue([result.frames for result in results], qtilde, [result.rel_err_hist for result in results],
+                       windows=windows)
 
 def save_frames(fname, frames,  error_matrix= None):
 
@@ -14,7 +14,11 @@ from scipy import sparse
 from numpy import meshgrid, size, reshape, floor
 import numpy as np
 import scipy.ndimage as ndimage
-from numba import njit
+from numba import njit, prange
+import os
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 # %%
 
 
@@ -41,41 +45,78 @@ def lagrange(xvals, xgrid, j):
 
     return Lj
 
-@njit()
-def lagrange_numba(xvals, xgrid, j):
+def lagrange_weights(xvals, xgrid):
     """
-    Returns the j-th basis polynomial evaluated at xvals
-    using the grid points listed in xgrid
+    Returns all basis polynomials L_0, ..., L_n of the grid points listed in xgrid
+    evaluated at xvals. The output has the shape [*np.shape(xvals), n+1]
     """
-    xgrid = np.asarray(xgrid)
-    for i,xval in enumerate([xvals]):
-        nominator = xval - xgrid
-        denominator = xgrid[j] - xgrid
-        p = nominator/(denominator+1e-32)                               #add SMALL for robustness
-        p[j] = 1
-        Lj = np.prod(p)
-
-    return Lj
-
-@njit()
-def meshgrid2D(x, y):
-    xx = np.empty(shape=(x.size, y.size), dtype=x.dtype)
-    yy = np.empty(shape=(x.size, y.size), dtype=y.dtype)
-    for j in range(y.size):
-            for k in range(x.size):
-                xx[j,k] = x[k]
-                yy[j,k] = y[j]
-    return yy, xx
-
-@njit()
-def compute_general_shift_matrix_numba( shifts, domain_size, spacings, Ngrid, Ix, Iy):
+    xgrid = np.asarray(xgrid, dtype=float)
+    n = np.size(xgrid)
+    # barycentric weights w_j = 1/prod_{m != j} (x_j - x_m)
+    dgrid = xgrid[:, None] - xgrid[None, :]
+    np.fill_diagonal(dgrid, 1)
+    w = 1 / np.prod(dgrid, axis=1)
+    # L_j(x) = w_j prod_{m != j} (x - x_m) is evaluated without dividing by (x - x_j),
+    # which makes it robust for x on the grid points
+    p = np.repeat((np.asarray(xvals, dtype=float)[..., None] - xgrid)[..., None, :], n, axis=-2)
+    p[..., np.arange(n), np.arange(n)] = 1
+
+    return w * np.prod(p, axis=-1)
+
+def stencil_offsets(order=3):
+    """
+    Returns the offsets of the Lagrange interpolation stencil of the given order
+    relative to the grid point idx_0 left of the interpolated point
+    """
+    if order == 5:
+        offsets = np.asarray([-2, -1, 0, 1, 2, 3], dtype=np.int32)
+    elif order == 3:
+        offsets = np.asarray([-1, 0, 1, 2], dtype=np.int32)
+    elif order == 1:
+        offsets = np.asarray([0, 1], dtype=np.int32)
+    else:
+        assert(False), "please choose correct order for interpolation"
+    return offsets
+
+def lagrange_stencil(shifts, domain_length, spacing, order=3):
     """
+    Computes the Lagrange interpolation stencils of all shifts in one call.
+    We assume periodicity of the domain.
 
-    :param shifts: shift(x_i,t_j) assumes an array of size i=0,...,Nx -1 ; j=0,...,Nt
-    :param domain_length:
-    :param spacings:
-    :param Npoints:
-    :return:
+    :param shifts: array of shifts of arbitrary shape, e.g. (Ntime,)
+    :return: base integer index idx_0 next to the shifted point, same shape as shifts
+             offsets (order+1,) of the stencil points relative to idx_0
+             weights Lagrange coefficients of the stencil points, shape [*np.shape(shifts), order+1]
+    """
+    ''' interpolation scheme        lagrange_idx(x)= (x-x_{idx-1})/(x_idx - x_0)+
+    -1      0   x    1       2                    ...+(x-x_{idx+2})/(x_idx - x_{idx+2})
+     +      +   x    +       +
+   idx_m1  idx_0    idx_1   idx_2
+  =idx_0-1        =idx_0+1
+   '''
+    offsets = stencil_offsets(order)
+    shifts = np.mod(shifts, domain_length)  # if periodicity is assumed
+    # shift is close to some discrete index:
+    base = floor(shifts / spacing)
+    # compute the distance to the index
+    delta_idx = shifts / spacing - base
+    weights = lagrange_weights(delta_idx, offsets)
+
+    return base.astype(np.int64), offsets, weights
+
+@njit(parallel=True)
+def compute_general_shift_matrix_numba(base, offsets, weights_x, weights_y, Ngrid):
+    """
+    Computes the nonzero elements of the general shift matrices T(t_1), ..., T(t_Nt),
+    where the shift delta(x_i,y_i,t) can depend on both spatial variables.
+    Every row ik = ix*Ny + iy has Nstencil**2 nonzero elements.
+
+    :param base: base indices (idx_0, idy_0) of the interpolation stencils, size 2 x Nx*Ny x Nt
+    :param offsets: offsets of the stencil points relative to the base index, size Nstencil
+    :param weights_x: Lagrange weights of the stencils in x direction, size Nx*Ny x Nt x Nstencil
+    :param weights_y: Lagrange weights of the stencils in y direction, size Nx*Ny x Nt x Nstencil
+    :param Ngrid: number of grid points (Nx, Ny)
+    :return: col, val column indices and values of the nonzero elements, size Nt x Nx*Ny x Nstencil**2
     """
 
     ''' interpolation scheme        lagrange_idx(x)= (x-x_{idx-1})/(x_idx - x_0)+
@@ -84,49 +125,569 @@ def compute_general_shift_matrix_numba( shifts, domain_size, spacings, Ngrid, Ix
    idx_m1  idx_0    idx_1   idx_2
   =idx_0-1        =idx_0+1
    '''
-    col = [np.int(x) for x in range(0)]
-    row = [np.int(x) for x in range(0)]
-    val = [np.float(x) for x in range(0)]
-    dx, dy = spacings
-    Nx, Ny = Ngrid
-    for ik in range(Nx*Ny):
-                # define shifts
-                shift_x = shifts[0,ik] # delta_1(x_i,y_i,t)
-                shift_x = np.mod(shift_x,domain_size[0]) # if periodicity is assumed
-                shift_y = shifts[1,ik] # delta_2(x_i,y_i,t)
-                shift_y = np.mod(shift_y,domain_size[1]) # if periodicity is assumed
-                # lexicographical index ik to local grid index ix, iy
-                (ix, iy) = (Ix[ik], Iy[ik])
-
-                # shift is close to sogenerame discrete index:
-                idx_0 = floor(shift_x / dx)
-                idy_0 = floor(shift_y / dy)
-                # save all neighbours
-                idx_list = np.asarray([idx_0 - 1, idx_0, idx_0 + 1, idx_0 + 2], dtype=np.int32) + ix
-                idx_list = np.asarray([np.mod(idx, Nx) for idx in idx_list]) # assumes periodicity
-                idy_list = np.asarray([idy_0 - 1, idy_0, idy_0 + 1, idy_0 + 2], dtype=np.int32) + iy
-                idy_list = np.asarray([np.mod(idy, Ny) for idy in idy_list])  # assumes periodicity
-                # compute the distance to the index
-                delta_idx = shift_x / dx - idx_0
-                delta_idy = shift_y / dy - idy_0
-                # compute the 4 langrage basis elements
-                lagrange_coefs_x = np.array([lagrange_numba(delta_idx, [-1, 0, 1, 2], j) for j in range(4)])
-                lagrange_coefs_y = np.array([lagrange_numba(delta_idy, [-1, 0, 1, 2], j) for j in range(4)])
-                lagrange_coefs = np.outer(lagrange_coefs_y, lagrange_coefs_x)
-                lagrange_coefs = lagrange_coefs.reshape((-1,))
-                #
-                IDX_mesh, IDY_mesh = meshgrid2D(idx_list, idy_list)
-                IK_mesh = IDX_mesh + IDY_mesh*Nx
-                IKs = IK_mesh.reshape((-1,))
-                col += list(IKs)
-                row += list(ik * np.ones_like(IKs))
-                val += list(lagrange_coefs)
-# if idx_list[0] < 0 : idx_list[0] += Npoints
-            # if idx_list[2] > Npoints - 1: idx_list[2] -= Npoints
-            # if idx_list[3] > Npoints - 1: idx_list[3] -= Npoints
-
-    val = np.asarray(val)
-    return col,row,val
+    Nx, Ny = Ngrid[0], Ngrid[1]
+    Npoints = Nx * Ny
+    Nt = base.shape[-1]
+    Nstencil = offsets.size
+    col = np.empty((Nt, Npoints, Nstencil * Nstencil), dtype=np.int32)
+    val = np.empty((Nt, Npoints, Nstencil * Nstencil))
+    for n in prange(Nt * Npoints):
+        it = n // Npoints
+        ik = n % Npoints
+        # lexicographical index ik to local grid index ix, iy
+        ix = ik // Ny
+        iy = ik % Ny
+        for jx in range(Nstencil):
+            # all neighbours, assumes periodicity
+            idx = (ix + base[0, ik, it] + offsets[jx]) % Nx
+            for jy in range(Nstencil):
+                idy = (iy + base[1, ik, it] + offsets[jy]) % Ny
+                col[it, ik, jx * Nstencil + jy] = idx * Ny + idy
+                val[it, ik, jx * Nstencil + jy] = weights_x[ik, it, jx] * weights_y[ik, it, jy]
+
+    return col, val
+
+def map_stencil_operator(points, Ngrid, Nvar=1, order=3, periodic=True, inside=None):
+    """
+    Computes the batched interpolation operator, which evaluates the field at the mapped grid points:
+        (T q)(x_i, t) = q(points[:, t, i], t)
+    using tensor products of Lagrange stencils, i.e. (order+1)**dim points per row.
+
+    :param points: mapped grid points in units of the lattice spacings, size dim x Ntime x prod(Ngrid),
+                   where the grid points are ordered lexicographically
+    :param Ngrid: number of grid points in every direction
+    :param Nvar: number of variables, every variable is interpolated separately
+    :param periodic: if true the stencil wraps around the domain, otherwise stencil points outside are zero
+    :param inside: boolean mask of size Ntime x prod(Ngrid), the rows of points which are not inside are zero
+    :return: BatchedOperator
+    """
+    dim, Ntime, Npoints = np.shape(points)
+    offsets = stencil_offsets(order)
+    Nstencil = np.size(offsets) ** dim
+    strides = np.cumprod([1] + list(Ngrid[:0:-1]))[::-1]
+    idx = np.empty([Ntime, Npoints, Nvar, Nstencil], dtype=np.int32)
+    weights = np.empty([Ntime, Npoints, Nvar, Nstencil])
+    # the operator is set up time step by time step to keep the temporary arrays small
+    for it in range(Ntime):
+        idx_t, weights_t = 0, 1
+        for d in range(dim):
+            base = floor(points[d, it])
+            coefs = lagrange_weights(points[d, it] - base, offsets)
+            nodes = base.astype(np.int64)[:, None] + offsets
+            if periodic:
+                nodes = np.mod(nodes, Ngrid[d])
+            else:
+                outside = (nodes < 0) | (nodes >= Ngrid[d])
+                coefs[outside] = 0
+                nodes[outside] = 0
+            shape = [Npoints] + [1] * dim
+            shape[1 + d] = np.size(offsets)
+            idx_t = idx_t + np.reshape(nodes * strides[d], shape)
+            weights_t = weights_t * np.reshape(coefs, shape)
+        if inside is not None:
+            weights_t = weights_t * np.reshape(inside[it], [-1] + [1] * dim)
+        idx[it] = np.reshape(idx_t, [Npoints, 1, -1]) * Nvar + np.arange(Nvar)[:, None]
+        weights[it] = np.reshape(weights_t, [Npoints, 1, -1])
+
+    return BatchedOperator(np.reshape(idx, [Ntime, Npoints * Nvar, Nstencil]),
+                           np.reshape(weights, [Ntime, Npoints * Nvar, Nstencil]))
+
+def compute_map_operator(maps, Ngrid, Ntime, Nvar=1, order=3, grid_points=None):
+    """
+    Computes the batched operator of a chain of coordinate maps phi_1, ..., phi_n:
+        (T q)(x, t) = q(phi_n(...phi_1(x, t)...), t)
+    The composed map is evaluated at the grid points and interpolated with a single stencil,
+    such that the operator has as many points per row as the operator of one map.
+    Points which are mapped outside of the domain by a non periodic map (rotation) are zero.
+
+    :param maps: list of tuples (phi, periodic), where phi maps the points (dim x Ntime x Npoints,
+                 in units of the lattice spacings) and periodic is true if the domain wraps around
+    :param grid_points: lexicographic indices of the grid points, at which the operator is computed (default: all).
+                        The operator has Nvar rows for every grid point.
+    :return: BatchedOperator
+    """
+    dim = len(Ngrid)
+    if grid_points is None:
+        grid_points = np.arange(np.prod(Ngrid))
+    points = np.stack([np.broadcast_to(index.astype(float), [Ntime, np.size(grid_points)])
+                       for index in np.unravel_index(grid_points, Ngrid)])
+    inside = None
+    for i, (phi, periodic) in enumerate(maps):
+        points = phi(points)
+        if periodic:
+            points = np.mod(points, np.reshape(Ngrid, [dim, 1, 1]))
+        elif i < len(maps) - 1:
+            inside_map = np.all((points >= 0) & (points <= np.reshape(Ngrid, [dim, 1, 1]) - 1), axis=0)
+            inside = inside_map if inside is None else inside & inside_map
+    periodic = maps[-1][1] if maps else True
+
+    return map_stencil_operator(points, Ngrid, Nvar, order, periodic, inside)
+
+def shift_map(shifts, domain_size, spacing, grid_points=None):
+    """
+    Returns the coordinate map x -> x + s(t) of a periodic shift in units of the lattice spacings
+    (see compute_map_operator).
+
+    :param shifts: separable shifts of size dim x Ntime (or Ntime in 1D), or general shifts delta(x_i, y_i, t)
+                   of size dim x Npoints x Ntime. The general shifts are only defined on the grid points,
+                   i.e. the map has to be the first of a chain.
+    :param grid_points: indices of the grid points of the general shifts, which are mapped (default: all)
+    :return: (phi, periodic)
+    """
+    dim = np.size(spacing)
+    if np.ndim(shifts) == 3:
+        shifts = np.transpose(shifts, [0, 2, 1])
+        if grid_points is not None:
+            shifts = shifts[:, :, grid_points]
+    else:
+        shifts = np.reshape(shifts, [dim, -1, 1])
+    domain_size = np.reshape(domain_size, [dim, 1, 1])
+    spacing = np.reshape(spacing, [dim, 1, 1])
+    delta = np.mod(shifts, domain_size) / spacing  # if periodicity is assumed
+    return (lambda points: points + delta), True
+
+def rotate_points(points, rotations, center, spacing, Ngrid):
+    """
+    Returns the rotated points x_0 + R(-omega(t))(x - x_0) in units of the lattice spacings
+
+    :param points: points x in units of the lattice spacings, size 2 x Ntime x Npoints
+    :param center: (x_0, y_0) position of the center of rotation, if None the center of the grid is used
+    """
+    dx, dy = spacing
+    if center is None:
+        center = [(Ngrid[0] - 1) * dx / 2, (Ngrid[1] - 1) * dy / 2]
+    X = points[0] * dx - center[0]
+    Y = points[1] * dy - center[1]
+    cos = np.cos(rotations)[:, None]
+    sin = np.sin(rotations)[:, None]
+    return np.stack([(center[0] + cos * X + sin * Y) / dx,
+                     (center[1] - sin * X + cos * Y) / dy])
+
+def rotation_map(rotations, center, spacing, Ngrid):
+    """
+    Returns the coordinate map of the rotation x -> x_0 + R(-omega(t))(x - x_0) in units of the lattice spacings
+    (see compute_map_operator). Points outside of the domain are zero.
+
+    :return: (phi, periodic)
+    """
+    return (lambda points: rotate_points(points, rotations, center, spacing, Ngrid)), False
+
+def parallel_time_chunks(fun, Ntime, n_workers=1):
+    """
+    Splits the time axis into n_workers chunks and calls fun(time_slice) for every chunk.
+    The chunks are processed by a thread pool, which pays off if fun releases the GIL
+    (numba kernels with nogil, scipy.ndimage, numpy.fft, ...).
+    """
+    if n_workers is None or n_workers < 1:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, Ntime)
+    if n_workers <= 1:
+        fun(slice(0, Ntime))
+        return
+    bounds = np.linspace(0, Ntime, n_workers + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(fun, slice(t_start, t_end)) for t_start, t_end in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+
+def write_output(field, out=None, accumulate=False):
+    """
+    Writes the field to the output buffer out (out = field) or adds it (out += field) if accumulate is true.
+    If no buffer is given the field is returned.
+    """
+    if out is None:
+        return field
+    out_view = np.reshape(out, np.shape(field))
+    assert np.shares_memory(out_view, out), "out has to be a contiguous array"
+    if accumulate:
+        out_view += field
+    else:
+        out_view[...] = field
+    return out
+
+@njit(nogil=True)
+def gather_apply_numba(field, idx, weights, out, t_start, t_end, accumulate):
+    """
+    Applies the stacked per-time operators to the columns t_start, ..., t_end-1 of the snapshot matrix:
+        out[i, t] = sum_s weights[t, i, s] * field[idx[t, i, s], t]
+    If accumulate is true the result is added to out.
+    """
+    Ntime, M, Nstencil = idx.shape
+    for it in range(t_start, t_end):
+        for i in range(M):
+            acc = 0.0
+            for s in range(Nstencil):
+                acc += weights[it, i, s] * field[idx[it, i, s], it]
+            if accumulate:
+                out[i, it] += acc
+            else:
+                out[i, it] = acc
+    return out
+
+
+class BatchedOperator:
+    """ Stack of all per-time interpolation operators T(t_1), ..., T(t_Ntime).
+        Every row of T(t) is stored as a list of gather indices and weights, which are
+        padded with zero weights to a common stencil size:
+            (T q)[i, t] = sum_s weights[t, i, s] * q[idx[t, i, s], t]
+        This allows to transform the whole snapshot matrix with a single vectorized call,
+        instead of one sparse matrix-vector product per time step.
+    """
+
+    def __init__(self, idx, weights):
+        self.idx = np.ascontiguousarray(idx, dtype=np.int32)
+        self.weights = np.ascontiguousarray(weights)
+        self.Ntime, self.M, self.Nstencil = self.idx.shape
+
+    @classmethod
+    def from_sparse_list(cls, mat_list):
+        """
+        Converts a list of sparse matrices [T(t_1), ..., T(t_Ntime)] into the stacked gather format.
+        """
+        mat_list = [sparse.csr_matrix(mat) for mat in mat_list]
+        for mat in mat_list:
+            mat.sum_duplicates()
+            mat.eliminate_zeros()
+        Ntime = len(mat_list)
+        M = mat_list[0].shape[0]
+        Nstencil = max(np.max(np.diff(mat.indptr), initial=0) for mat in mat_list)
+        idx = np.zeros([Ntime, M, Nstencil], dtype=np.int32)
+        weights = np.zeros([Ntime, M, Nstencil])
+        for it, mat in enumerate(mat_list):
+            # position of every nonzero element inside its row
+            rows = np.repeat(np.arange(M), np.diff(mat.indptr))
+            pos = np.arange(mat.nnz) - mat.indptr[rows]
+            idx[it, rows, pos] = mat.indices
+            weights[it, rows, pos] = mat.data
+
+        return cls(idx, weights)
+
+    @classmethod
+    def from_stencils(cls, grid_shape, stencils):
+        """
+        Builds the gather operator of separable shifts directly from the interpolation stencils
+        (see lagrange_stencil) without setting up sparse matrices.
+
+        :param grid_shape: shape of a single snapshot, e.g. [Nx, Ny, Nvar]
+        :param stencils: list with one tuple (base, offsets, weights) for every shifted axis of the grid
+        """
+        Ndim = len(grid_shape)
+        Nshifted = len(stencils)
+        Ntime = np.size(stencils[0][0])
+        strides = np.cumprod([1] + list(grid_shape[:0:-1]))[::-1]
+        # idx and weights have the shape [Ntime, *grid_shape, Nstencil_1, ..., Nstencil_Nshifted]
+        idx, weights = 0, 1
+        for axis in range(Ndim):
+            N = grid_shape[axis]
+            shape = [1] * (1 + Ndim + Nshifted)
+            shape[1 + axis] = N
+            if axis < Nshifted:
+                base, offsets, coefs = stencils[axis]
+                shape[0] = Ntime
+                shape[1 + Ndim + axis] = np.size(offsets)
+                grid_idx = np.mod(np.arange(N)[None, :, None] + base[:, None, None] + offsets[None, None, :], N)
+                idx = idx + np.reshape(grid_idx * strides[axis], shape)
+                shape[1 + axis] = 1
+                weights = weights * np.reshape(coefs, shape)
+            else:
+                idx = idx + np.reshape(np.arange(N) * strides[axis], shape)
+        M = np.prod(grid_shape)
+        idx = np.broadcast_to(idx, np.broadcast_shapes(np.shape(idx), np.shape(weights)))
+        weights = np.broadcast_to(weights, np.shape(idx))
+
+        return cls(np.reshape(idx, [Ntime, M, -1]), np.reshape(weights, [Ntime, M, -1]))
+
+    def to_sparse_list(self):
+        """
+        Returns the list of sparse matrices [T(t_1), ..., T(t_Ntime)]
+        """
+        rows = np.repeat(np.arange(self.M), self.Nstencil)
+        return [sparse.csr_matrix((self.weights[it].reshape(-1), (rows, self.idx[it].reshape(-1))),
+                                  shape=[self.M, self.M]) for it in range(self.Ntime)]
+
+    def astype(self, dtype):
+        """
+        Returns the operator with weights of the given floating point type
+        """
+        return BatchedOperator(self.idx, self.weights.astype(dtype))
+
+    def select_time(self, ts):
+        """
+        Returns the operator of the time steps ts (slice or array of indices)
+        """
+        return BatchedOperator(self.idx[ts], self.weights[ts])
+
+    def append_time(self, other):
+        """
+        Returns the operator of the time steps of self followed by the time steps of other
+        """
+        Nstencil = max(self.Nstencil, other.Nstencil)
+        pad = lambda array, op: np.pad(array, [(0, 0), (0, 0), (0, Nstencil - op.Nstencil)])
+        return BatchedOperator(np.concatenate([pad(self.idx, self), pad(other.idx, other)]),
+                               np.concatenate([pad(self.weights, self), pad(other.weights, other)]))
+
+    def apply(self, field, n_workers=1, out=None, accumulate=False):
+        """
+        Applies T(t_j) to the j-th column of the snapshot matrix field of size M x Ntime.
+        The result is written to out (or added to out if accumulate is true) if a buffer of size M x Ntime is given.
+        """
+        field = np.ascontiguousarray(field)
+        if out is None:
+            out = np.empty(np.shape(field), dtype=np.result_type(field, self.weights))
+            accumulate = False
+        parallel_time_chunks(lambda ts: gather_apply_numba(field, self.idx, self.weights, out, ts.start, ts.stop,
+                                                           accumulate), self.Ntime, n_workers)
+        return out
+
+
+class StencilOperator:
+    """ Matrix free representation of the separable shift operators T(t_1), ..., T(t_Ntime).
+        For every axis of the grid only the integer base offset and the Lagrange weights
+        of each time step are stored:
+            (T q)[i, t] = sum_s weights[t, s] * q[mod(i + base[t] + offsets[s], N), t]
+        The shift is applied axis by axis with a periodic gather.
+    """
+
+    def __init__(self, grid_shape, stencils):
+        """
+        :param grid_shape: shape of a single snapshot, e.g. [Nx, Ny, Nvar]
+        :param stencils: list with one tuple (base, offsets, weights) for every shifted axis of the grid
+        """
+        self.grid_shape = list(grid_shape)
+        self.stencils = stencils
+
+    def astype(self, dtype):
+        """
+        Returns the operator with weights of the given floating point type
+        """
+        return StencilOperator(self.grid_shape, [(base, offsets, weights.astype(dtype))
+                                                 for base, offsets, weights in self.stencils])
+
+    def select_time(self, ts):
+        """
+        Returns the operator of the time steps ts (slice or array of indices)
+        """
+        return StencilOperator(self.grid_shape, [(base[ts], offsets, weights[ts])
+                                                 for base, offsets, weights in self.stencils])
+
+    def append_time(self, other):
+        """
+        Returns the operator of the time steps of self followed by the time steps of other
+        """
+        stencils = []
+        for (base, offsets, weights), (base_other, offsets_other, weights_other) in zip(self.stencils, other.stencils):
+            assert np.array_equal(offsets, offsets_other), "the interpolation orders have to be the same"
+            stencils.append((np.concatenate([base, base_other]), offsets, np.concatenate([weights, weights_other])))
+        return StencilOperator(self.grid_shape, stencils)
+
+    def apply(self, field, n_workers=1, out=None, accumulate=False):
+        """
+        Applies T(t_j) to the j-th column of the snapshot matrix field of size M x Ntime.
+        The result is written to out (or added to out if accumulate is true) if a buffer of size M x Ntime is given.
+        """
+        Ntime = np.size(field, -1)
+        field = np.reshape(field, [-1, Ntime])
+        if out is None:
+            out = np.empty(np.shape(field), dtype=np.result_type(field, *[weights for _, _, weights in self.stencils]))
+            accumulate = False
+
+        def apply_chunk(ts):
+            write_output(self.apply_time_slice(field[:, ts], ts), out[:, ts], accumulate)
+
+        parallel_time_chunks(apply_chunk, Ntime, n_workers)
+        return out
+
+    def apply_time_slice(self, field, ts):
+        """
+        Applies T(t_j) for the time steps j in the slice ts to the columns of field
+        """
+        Ntime = np.size(field, -1)
+        field = np.reshape(field, [*self.grid_shape, Ntime])
+        for axis, (base, offsets, weights) in enumerate(self.stencils):
+            base, weights = base[ts], weights[ts]
+            N = self.grid_shape[axis]
+            index_shape = [1] * np.ndim(field)
+            index_shape[axis], index_shape[-1] = N, Ntime
+            grid_idx = np.arange(N)[:, None] + base[None, :]
+            field_shift = 0
+            for s, offset in enumerate(offsets):
+                idx = np.reshape(np.mod(grid_idx + offset, N), index_shape)
+                field_shift = field_shift + weights[:, s] * np.take_along_axis(field, idx, axis=axis)
+            field = field_shift
+
+        return np.reshape(field, [-1, Ntime])
+
+
+class SpectralOperator:
+    """ Spectral representation of the separable shift operators T(t_1), ..., T(t_Ntime) for periodic domains.
+        The shift is exact for all resolved wavenumbers:
+            (T q)(x, t) = q(x + s(t), t) = sum_k exp(i k s(t)) qhat(k, t) exp(i k x)
+        The phase tables exp(i k s(t)) are precomputed for every shifted axis and all time steps
+        are transformed at once using real FFTs.
+        On grids with an even number of points the Nyquist mode is not shifted (phase 1 in both directions),
+        such that T^(-k) o T^k is the identity up to round-off.
+    """
+
+    def __init__(self, grid_shape, phases):
+        """
+        :param grid_shape: shape of a single snapshot, e.g. [Nx, Ny, Nvar]
+        :param phases: list of phase tables of size (Nk, Ntime), one for every shifted axis of the grid.
+                       The last shifted axis is transformed with rfft.
+        """
+        self.grid_shape = list(grid_shape)
+        self.phases = phases
+        self.axes = list(range(len(phases)))
+
+    def astype(self, dtype):
+        """
+        Returns the operator with phase tables of the complex type matching the floating point type dtype
+        """
+        return SpectralOperator(self.grid_shape, [phase.astype(np.result_type(dtype, np.complex64))
+                                                  for phase in self.phases])
+
+    def select_time(self, ts):
+        """
+        Returns the operator of the time steps ts (slice or array of indices)
+        """
+        return SpectralOperator(self.grid_shape, [phase[:, ts] for phase in self.phases])
+
+    def append_time(self, other):
+        """
+        Returns the operator of the time steps of self followed by the time steps of other
+        """
+        return SpectralOperator(self.grid_shape, [np.concatenate([phase, phase_other], axis=1)
+                                                  for phase, phase_other in zip(self.phases, other.phases)])
+
+    def apply(self, field, n_workers=1, out=None, accumulate=False):
+        """
+        Applies T(t_j) to the j-th column of the snapshot matrix field of size M x Ntime.
+        The result is written to out (or added to out if accumulate is true) if a buffer of size M x Ntime is given.
+        """
+        Ntime = np.size(field, -1)
+        field = np.reshape(field, [-1, Ntime])
+        if out is None:
+            out = np.empty(np.shape(field), dtype=np.result_type(field, *[phase.real for phase in self.phases]))
+            accumulate = False
+
+        def apply_chunk(ts):
+            write_output(self.apply_time_slice(field[:, ts], ts), out[:, ts], accumulate)
+
+        parallel_time_chunks(apply_chunk, Ntime, n_workers)
+        return out
+
+    def apply_time_slice(self, field, ts):
+        """
+        Applies T(t_j) for the time steps j in the slice ts to the columns of field
+        """
+        Ntime = np.size(field, -1)
+        field = np.reshape(field, [*self.grid_shape, Ntime])
+        field_hat = np.fft.rfftn(field, axes=self.axes)
+        for axis, phase in enumerate(self.phases):
+            phase = phase[:, ts]
+            phase_shape = [1] * np.ndim(field)
+            phase_shape[axis], phase_shape[-1] = np.shape(phase)
+            field_hat *= np.reshape(phase, phase_shape)
+        field = np.fft.irfftn(field_hat, s=[self.grid_shape[axis] for axis in self.axes], axes=self.axes)
+
+        return np.reshape(field, [-1, Ntime])
+
+
+class OperatorCache:
+    """ Persistent on-disk cache of the batched shift operators.
+        Every entry is a directory named by the hash of all parameters that define the operators.
+        The gather indices and weights are stored as .npy files and memory-mapped when they are loaded again.
+        If the size of the cache exceeds max_size (in bytes), the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_size=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, **params):
+        """
+        Returns the hash of all parameters which define the transformation operators
+        """
+        h = hashlib.sha1()
+        for name in sorted(params):
+            value = np.ascontiguousarray(params[name])
+            h.update(name.encode())
+            h.update(str((value.dtype, value.shape)).encode())
+            h.update(value.tobytes())
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        Returns the memory-mapped operators (T^k, T^(-k)) or None if they are not in the cache
+        """
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        operators = tuple(BatchedOperator(np.load(os.path.join(path, name + "_idx.npy"), mmap_mode="r"),
+                                          np.load(os.path.join(path, name + "_weights.npy"), mmap_mode="r"))
+                          for name in ["pos", "neg"])
+        os.utime(path)  # mark as recently used
+        return operators
+
+    def save(self, key, operators):
+        """
+        Stores the operators (T^k, T^(-k)) in the cache
+        """
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = path + ".tmp%d" % os.getpid()
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, operator in zip(["pos", "neg"], operators):
+            np.save(os.path.join(tmp_path, name + "_idx.npy"), operator.idx)
+            np.save(os.path.join(tmp_path, name + "_weights.npy"), operator.weights)
+        if os.path.isdir(path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is smaller than max_size
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and ".tmp" not in name:
+                size_entry = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size_entry, path))
+        entries.sort()
+        total_size = sum(entry[1] for entry in entries)
+        # the most recent entry is always kept
+        for mtime, size_entry, path in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size_entry
+
+
+def compose_transforms(trafo_list):
+    """
+    Fuses a chain of transformations into a single transformation
+        T = T_1 o T_2 o ... o T_n        (T_n is applied first)
+        T^(-1) = T_n^(-1) o ... o T_1^(-1)
+    The coordinate maps of the transformations are composed and interpolated with a single stencil
+    (see compute_map_operator), such that applying T needs only one pass over the snapshot matrix
+    and the operator is not larger than the operator of a single transformation.
+    All transformations need coordinate maps (no scipy transforms) and the same data_shape.
+    The Lagrange interpolation order of T_1 is used.
+
+    :param trafo_list: list of transforms [T_1, ..., T_n]
+    :return: transforms object of the composite transformation
+    """
+    import copy
+    assert all(trafo.data_shape == trafo_list[0].data_shape for trafo in trafo_list), "data_shape must be the same"
+
+    composite = copy.copy(trafo_list[0])
+    composite.trafo_type = "composite"
+    for name in ["shifts_pos", "shifts_neg", "rotations_pos", "rotations_neg"]:
+        setattr(composite, name, None)
+    composite.fused_pos, composite.fused_neg = composite.init_fused_operators(trafo_list)
+    return composite
 
 
 class transforms:
@@ -138,7 +699,21 @@ class transforms:
     """
 
     def __init__(self, data_shape, domain_size, trafo_type="shift", shifts = None, \
-                 dx = None, rotations=None, rotation_center = None, use_scipy_transform = False, interp_order=3):
+                 dx = None, rotations=None, rotation_center = None, use_scipy_transform = False, interp_order=3,
+                 use_matrix_free = False, cache_dir = None, cache_max_size = 10 * 2 ** 30, n_workers = 1, dtype = None,
+                 use_fused_operator = True):
+        """
+        :param interp_order: order 1, 3 or 5 of the Lagrange interpolation used in the shift.
+                             A list [order_forward, order_backward] allows different orders for T^k and T^(-k).
+                             For periodic domains interp_order="spectral" uses exact shifts in Fourier space.
+        :param use_matrix_free: if true only the interpolation stencils are stored instead of the shift matrices
+        :param cache_dir: if given, the shift operators are stored in and reloaded from this directory (see OperatorCache)
+        :param cache_max_size: maximal size of the operator cache in bytes
+        :param n_workers: number of threads used to transform the time slices in parallel (-1 uses all cores)
+        :param dtype: floating point type of the operators, e.g. np.float32 (default: np.float64)
+        :param use_fused_operator: if true shiftRot is applied by a single operator per time step, which interpolates
+                                   the field at the shifted and rotated grid points (see compute_map_operator)
+        """
         self.Ngrid = data_shape[:2]
         self.Nvar = data_shape[2]
         self.Ntime = data_shape[3]
@@ -148,8 +723,25 @@ class transforms:
         self.dim = size(dx)
         self.interp_order = interp_order
         self.dx = dx  # list of lattice spacings
+        self.shifts = None if shifts is None else np.asarray(shifts)
+        self.use_scipy_transform = use_scipy_transform
+        # options of the transformation, which are used to set it up for other shifts and rotations (see copy_with)
+        self.options = dict(domain_size=domain_size, trafo_type=trafo_type, dx=dx, rotation_center=rotation_center,
+                            use_scipy_transform=use_scipy_transform, interp_order=interp_order,
+                            use_matrix_free=use_matrix_free, cache_dir=cache_dir, cache_max_size=cache_max_size,
+                            n_workers=n_workers, use_fused_operator=use_fused_operator)
+        self.use_matrix_free = use_matrix_free # only the stencils are stored and no shift matrices
+        self.operator_cache = OperatorCache(cache_dir, cache_max_size) if cache_dir is not None else None
+        self.fused_pos, self.fused_neg = None, None # single operators of composite transformations
+        self.n_workers = n_workers
+        self.dtype = np.float64 # floating point type of the operators
         if self.dim == 1:
-            self.shifts_pos, self.shifts_neg = self.init_shifts_1D(dx[0], domain_size[0], self.Ngrid[0], shifts[:], Nvar=self.Nvar)
+            if interp_order == "spectral":
+                self.shifts_pos, self.shifts_neg = self.init_shifts_spectral(dx, domain_size, self.Ngrid, shifts)
+            elif use_matrix_free:
+                self.shifts_pos, self.shifts_neg = self.init_shift_stencils(dx, domain_size, self.Ngrid, shifts)
+            else:
+                self.shifts_pos, self.shifts_neg = self.init_shifts(dx, domain_size, shifts)
             self.shift = self.shift1
         else:
             if trafo_type=="shift":
@@ -160,29 +752,135 @@ class transforms:
                     one[0,:]=dx[0]
                     one[1,:]=0#dx[1]
                     self.shifts_neg = -shifts  # dim x Ntime shiftarray (one element for one time instance)
+                elif interp_order == "spectral":
+                    self.shifts_pos, self.shifts_neg = self.init_shifts_spectral(dx, domain_size, self.Ngrid, shifts)
+                    self.shift = self.shift1
+                elif use_matrix_free:
+                    self.shifts_pos, self.shifts_neg = self.init_shift_stencils(dx, domain_size, self.Ngrid, shifts)
+                    self.shift = self.shift1
                 else: # own implementation for shifts: is much faster then ndimage
-                    self.shifts_pos, self.shifts_neg = self.init_shifts_2D(dx, domain_size, self.Ngrid, shifts, Nvar= self.Nvar)
+                    self.shifts_pos, self.shifts_neg = self.init_shifts(dx, domain_size, shifts)
                     self.shift = self.shift1
             if trafo_type=="rotation":
                 assert(size(dx)==2), "is only implemented for spatial fields in 2 dimensions"
                 #assert(np.sum(rotation_center)==0), "rotation center should be in the middle!"
-                self.rotations = rotations # is an array with [omega(t_1), ... omega(t_Ntime)] rotation angles at different timepoints
+                self.rotations = np.asarray(rotations) # is an array with [omega(t_1), ... omega(t_Ntime)] rotation angles at different timepoints
                 self.rotation_center = rotation_center # array including center of rotation(x_0, y_0)
+                self.init_rotate(use_scipy_transform)
             if trafo_type=="shiftRot":
                 assert(size(dx)==2), "is only implemented for spatial fields in 2 dimensions"
-                if use_scipy_transform:
+                self.rotations = np.asarray(rotations)
+                self.rotation_center = rotation_center
+                if use_fused_operator and not use_scipy_transform and not use_matrix_free \
+                        and interp_order != "spectral" and np.ndim(shifts) == 2:
+                    # rotation and shift are combined into one operator for each time step
+                    self.shift, self.rotate = self.shift1, self.rotate1
+                    self.shifts_pos, self.shifts_neg = None, None
+                    self.rotations_pos, self.rotations_neg = None, None
+                    self.fused_pos, self.fused_neg = self.init_fused_operators([self])
+                elif use_scipy_transform:
                     self.shift = self.shift_scipy
                     self.shifts_pos =  shifts    # dim x Ntime shiftarray (one element for one time instance)
                     self.shifts_neg = -shifts  # dim x Ntime shiftarray (one element for one time instance)
+                elif interp_order == "spectral":
+                    self.shifts_pos, self.shifts_neg = self.init_shifts_spectral(dx, domain_size, self.Ngrid, shifts)
+                    self.shift = self.shift1
+                elif use_matrix_free:
+                    self.shifts_pos, self.shifts_neg = self.init_shift_stencils(dx, domain_size, self.Ngrid, shifts)
+                    self.shift = self.shift1
                 else: # own implementation for shifts: is much faster then ndimage
-                    self.shifts_pos, self.shifts_neg = self.init_shifts_2D(dx, domain_size, self.Ngrid, shifts, Nvar= self.Nvar)
+                    self.shifts_pos, self.shifts_neg = self.init_shifts(dx, domain_size, shifts)
                     self.shift = self.shift1
-                self.rotations = rotations
-                self.rotation_center = rotation_center
+                if self.fused_pos is None:
+                    self.init_rotate(use_scipy_transform)
+        if dtype is not None:
+            self.cast_operators(dtype)
 
+    def cast_operators(self, dtype):
+        """
+        Converts all operators of the transformation to the floating point type dtype.
+        The scipy transforms (use_scipy_transform) keep the precision of the input field.
+        """
+        operator_types = (BatchedOperator, StencilOperator, SpectralOperator)
+        for name in ["shifts_pos", "shifts_neg", "rotations_pos", "rotations_neg", "fused_pos", "fused_neg"]:
+            operator = getattr(self, name, None)
+            if isinstance(operator, operator_types):
+                setattr(self, name, operator.astype(dtype))
+        self.dtype = dtype
+
+    def astype(self, dtype):
+        """
+        Returns a copy of the transformation with operators of the floating point type dtype.
+        The operators of the original transformation are kept, such that it can still be used for
+        computations in higher precision.
+        """
+        import copy
+        new = copy.copy(self)
+        new.cast_operators(dtype)
+        return new
 
+    def select_time(self, ts):
+        """
+        Returns a copy of the transformation, which only acts on the time steps ts (slice or array of indices),
+        i.e. on the snapshot matrix q[:, ts]. The operators are not copied if ts is a slice.
+        """
+        import copy
+        new = copy.copy(self)
+        new.Ntime = np.size(np.arange(self.Ntime)[ts])
+        new.data_shape = [*self.data_shape[:3], new.Ntime]
+        operator_types = (BatchedOperator, StencilOperator, SpectralOperator)
+        for name in ["shifts_pos", "shifts_neg", "rotations_pos", "rotations_neg", "fused_pos", "fused_neg"]:
+            operator = getattr(self, name, None)
+            if isinstance(operator, operator_types):
+                setattr(new, name, operator.select_time(ts))
+            elif operator is not None:
+                # shifts and rotation angles of the scipy transforms
+                setattr(new, name, np.asarray(operator)[..., ts])
+        if getattr(self, "rotations", None) is not None:
+            new.rotations = np.asarray(self.rotations)[..., ts]
+        if getattr(self, "shifts", None) is not None:
+            new.shifts = self.shifts[..., ts]
+        return new
+
+    def append_time(self, other):
+        """
+        Returns a copy of the transformation, which acts on the time steps of self followed by
+        the time steps of other. other has to be set up for the same grid with the same options,
+        e.g. for the next snapshots of a simulation.
+        """
+        import copy
+        new = copy.copy(self)
+        new.Ntime = self.Ntime + other.Ntime
+        new.data_shape = [*self.data_shape[:3], new.Ntime]
+        operator_types = (BatchedOperator, StencilOperator, SpectralOperator)
+        for name in ["shifts_pos", "shifts_neg", "rotations_pos", "rotations_neg", "fused_pos", "fused_neg"]:
+            operator = getattr(self, name, None)
+            if isinstance(operator, operator_types):
+                setattr(new, name, operator.append_time(getattr(other, name)))
+            elif operator is not None:
+                # shifts and rotation angles of the scipy transforms
+                setattr(new, name, np.concatenate([np.asarray(operator), np.asarray(getattr(other, name))], axis=-1))
+        if getattr(self, "rotations", None) is not None:
+            new.rotations = np.concatenate([np.asarray(self.rotations), np.asarray(other.rotations)], axis=-1)
+        if getattr(self, "shifts", None) is not None:
+            new.shifts = np.concatenate([self.shifts, other.shifts], axis=-1)
+        return new
+
+
+
+    def copy_with(self, shifts=None, rotations=None):
+        """
+        Returns a new transformation with the same options (grid, interpolation, ...) for the given
+        shifts and rotations. The number of time steps is given by the last axis of the shifts or rotations,
+        e.g. to set up the transformation of all snapshots from the shifts of several batches.
+        """
+        assert self.trafo_type != "composite", "composite transformations have to be composed again"
+        Ntime = np.shape(shifts)[-1] if shifts is not None else np.size(rotations)
+        dtype = None if self.dtype == np.float64 else self.dtype
+        return transforms([*self.data_shape[:3], Ntime], shifts=shifts, rotations=rotations, dtype=dtype,
+                          **self.options)
 
-    def apply(self, field):
+    def apply(self, field, out=None, accumulate=False):
         """
         This function returns the shifted field.
         $q(x-s,t)=T^s[q(x,t)]$
@@ -193,25 +891,31 @@ class transforms:
         Before we shift the frame has to be put togehter in the co-moving
         frame. This can be done by build_field().
 
+        If a contiguous buffer out of the same size as field is given, the result is written to it
+        (out = T[q]) or added to it (out += T[q]) if accumulate is true. out must not overlap with field.
         """
         input_shape = np.shape(field)
         field = reshape(field,self.data_shape)
         if self.trafo_type=="shift":
-            ftrans = self.shift(field, self.shifts_pos)
+            ftrans = self.shift(field, self.shifts_pos, out, accumulate)
         elif self.trafo_type == "rotation":
-            ftrans = self.rotate(field, self.rotations)
+            ftrans = self.rotate(field, self.rotations_pos, out, accumulate)
+        elif self.fused_pos is not None:
+            ftrans = self.apply_operator(field, self.fused_pos, out, accumulate)          #rotate and shift in one step
         elif self.trafo_type == "shiftRot":
             # ~ auxField = self.shift(field,self.shiftMatrices_pos)         #shift to origin
-            field = self.rotate(field,self.rotations)                 #rotate and return
-            ftrans = self.shift(field,self.shifts_pos)                   #shift to origin
+            field = self.rotate(field,self.rotations_pos)                 #rotate and return
+            ftrans = self.shift(field,self.shifts_pos, out, accumulate)                   #shift to origin
         elif self.trafo_type == "identity":
-            ftrans = field
+            ftrans = write_output(field, out, accumulate)
         else:
             print("Transformation type: %s not known"%self.trafo_type)
 
+        if out is not None:
+            return out
         return reshape(ftrans, input_shape)
 
-    def reverse(self, field):
+    def reverse(self, field, out=None, accumulate=False):
         """
         This function returns the shifted field.
         $q(x-s,t)=T^s[q(x,t)]$
@@ -221,26 +925,67 @@ class transforms:
         ( You may call it the labratory frame)
         Before we shift the frame has to be put togehter in the co-moving
         frame. This can be done by build_field().
+
+        If a contiguous buffer out of the same size as field is given, the result is written to it
+        (out = T^(-1)[q]) or added to it (out += T^(-1)[q]) if accumulate is true. out must not overlap with field.
         """
         input_shape = np.shape(field)
         field = reshape(field, self.data_shape)
         if self.trafo_type=="shift":
-            ftrans = self.shift(field,self.shifts_neg)
+            ftrans = self.shift(field,self.shifts_neg, out, accumulate)
         elif self.trafo_type == "rotation":
-            ftrans = self.rotate(field, -self.rotations)
+            ftrans = self.rotate(field, self.rotations_neg, out, accumulate)
+        elif self.fused_neg is not None:
+            ftrans = self.apply_operator(field, self.fused_neg, out, accumulate)          #shift and rotate back in one step
         elif self.trafo_type == "shiftRot":
             field = self.shift(field,self.shifts_neg)                   #shift back and return
-            ftrans = self.rotate(field,-self.rotations)               #rotate back
+            ftrans = self.rotate(field,self.rotations_neg, out, accumulate)               #rotate back
             # ~ return self.shift(auxField,self.shiftMatrices_neg)          #shift back and return
 
         elif self.trafo_type == "identity":
-            ftrans = field
+            ftrans = write_output(field, out, accumulate)
         else:
             print("Transformation type: %s not known"%self.trafo_type)
 
+        if out is not None:
+            return out
         return reshape(ftrans, input_shape)
 
-    def shift1(self, field, shifts):
+    def operators(self):
+        """
+        Returns the batched operators (T^k, T^(-k)) of the transformation,
+        or None if the transformation is not represented by batched operators
+        (e.g. ndimage, matrix free or spectral transforms).
+        """
+        if self.fused_pos is not None:
+            operators = (self.fused_pos, self.fused_neg)
+        elif self.trafo_type == "shift":
+            operators = (self.shifts_pos, self.shifts_neg)
+        elif self.trafo_type == "rotation":
+            operators = (self.rotations_pos, self.rotations_neg)
+        else:
+            return None
+        if all(isinstance(op, BatchedOperator) for op in operators):
+            return operators
+        return None
+
+    def apply_operator(self, field, operator, out=None, accumulate=False):
+        """
+        Applies a batched operator to all time slices of the field.
+        The result is written to (or added to) the buffer out if given.
+        """
+        Ntime = np.size(field,-1)
+        out_mat = None
+        if out is not None:
+            out_mat = np.reshape(out, [-1, Ntime])
+            assert np.shares_memory(out_mat, out), "out has to be a contiguous array"
+        field_trans = operator.apply(np.reshape(field, [-1, Ntime]), n_workers=self.n_workers,
+                                     out=out_mat, accumulate=accumulate)
+        if out is not None:
+            return out
+        return np.reshape(field_trans, np.shape(field))
+
+    def shift1(self, field, shifts, out=None, accumulate=False):
         """
         This function returns the shifted field.
         $q(x-s,t)=T^s[q(x,t)]$
@@ -252,16 +997,10 @@ class transforms:
         frame. This can be done by build_field().
         
         """
-        Ntime = np.size(field,-1)
-        field_shift = np.zeros_like(field)
-        for it in range(Ntime):
-            vec = np.reshape(field[...,it],-1)
-            vec_shift = shifts[it]@vec
-            field_shift[...,it] = np.reshape(vec_shift,self.data_shape[:-1])
-
-        return field_shift
+        # all time slices are shifted at once by the batched operator
+        return self.apply_operator(field, shifts, out, accumulate)
         
-    def shift_scipy(self,field,shifts):
+    def shift_scipy(self,field,shifts, out=None, accumulate=False):
         """
         This function returns the shifted field.
         $q(x-s,t)=T^s[q(x,t)]$ 
@@ -275,34 +1014,73 @@ class transforms:
         """
         input_shape = np.shape(field)
         Ntime = np.size(field,-1)
-        field_shift = np.zeros([*self.Ngrid,Ntime])
-        for it in range(Ntime):
-
-            #DeltaS = -np.round(np.divide(shifts[:, it], self.dx))
-            DeltaS = -np.divide(shifts[:, it], self.dx)
-            q = np.reshape(field[...,it], self.Ngrid)
-            #field_shift[...,it] = np.roll(q, int(DeltaS[1]), axis=1)
-            #field_shift[..., it] = np.roll(q, DeltaS[0], axis=1)
-            #q = np.reshape(field[...,it], self.Ngrid)
-            field_shift[...,it] = ndimage.shift(q,DeltaS,mode='grid-wrap')
-        return np.reshape(field_shift,input_shape)
+        field_shift = np.zeros([*self.Ngrid,Ntime], dtype=np.result_type(field, np.float32))
+
+        def shift_chunk(ts):
+            for it in range(ts.start, ts.stop):
+
+                #DeltaS = -np.round(np.divide(shifts[:, it], self.dx))
+                DeltaS = -np.divide(shifts[:, it], self.dx)
+                q = np.reshape(field[...,it], self.Ngrid)
+                #field_shift[...,it] = np.roll(q, int(DeltaS[1]), axis=1)
+                #field_shift[..., it] = np.roll(q, DeltaS[0], axis=1)
+                #q = np.reshape(field[...,it], self.Ngrid)
+                field_shift[...,it] = ndimage.shift(q,DeltaS,mode='grid-wrap')
+
+        parallel_time_chunks(shift_chunk, Ntime, self.n_workers)
+        return write_output(np.reshape(field_shift,input_shape), out, accumulate)
     # Note (MI): the shifts need to be scaled w.r.t the image and are
     #            reversed 
     
-    def rotate(self, field, rotations):
+    def rotate1(self, field, rotations, out=None, accumulate=False):
+        """
+        This function returns the rotated field.
+        The rotations are given by the batched rotation operator of all time steps,
+        which is precomputed in init_rotations.
+        """
+        # all time slices are rotated at once by the batched operator
+        return self.apply_operator(field, rotations, out, accumulate)
+
+    def rotate_scipy(self, field, rotations, out=None, accumulate=False):
         
         input_shape = np.shape(field)
         Ntime = np.size(field,-1)
-        field_rot = np.zeros([*self.Ngrid,Ntime])
-        for it in range(Ntime):
-            angle = rotations[it]
-            q = np.reshape(field[...,it], self.Ngrid)
-            field_rot[...,it] = ndimage.rotate(q, angle*180.0/np.pi, reshape=False)
-            
-        return np.reshape(field_rot,input_shape)
+        field_rot = np.zeros([*self.Ngrid,Ntime], dtype=np.result_type(field, np.float32))
+
+        def rotate_chunk(ts):
+            for it in range(ts.start, ts.stop):
+                angle = rotations[it]
+                q = np.reshape(field[...,it], self.Ngrid)
+                field_rot[...,it] = ndimage.rotate(q, angle*180.0/np.pi, reshape=False)
+
+        parallel_time_chunks(rotate_chunk, Ntime, self.n_workers)
+        return write_output(np.reshape(field_rot,input_shape), out, accumulate)
             
             
             
+    def init_shifts(self, dX, domain_size, shifts):
+        """
+        Sets up the batched shift operators T^k and T^(-k).
+        If an operator cache is used, the operators are reloaded when they have been computed before.
+        """
+        if self.operator_cache is not None:
+            key = self.operator_cache.key(data_shape=self.data_shape, domain_size=domain_size, dx=dX,
+                                          shifts=shifts, interp_order=self.interp_order, trafo_type=self.trafo_type)
+            operators = self.operator_cache.load(key)
+            if operators is not None:
+                print("Shift operators loaded from cache: %s" % key)
+                return operators
+
+        if self.dim == 1:
+            operators = self.init_shifts_1D(dX[0], domain_size[0], self.Ngrid[0], shifts[:], Nvar=self.Nvar)
+        else:
+            operators = self.init_shifts_2D(dX, domain_size, self.Ngrid, shifts, Nvar=self.Nvar)
+
+        if self.operator_cache is not None:
+            self.operator_cache.save(key, operators)
+
+        return operators
+
     def init_shifts_2D(self, dX, domain_size, Ngrid, shifts, Nvar = 1):
         ### implement pos shift matrix ###
 
@@ -322,9 +1100,6 @@ class transforms:
         dx, dy = dX
         Nt = np.size(shifts,-1)
 
-        shift_pos_mat_list = []
-        shift_neg_mat_list = []
-
         if np.ndim(shifts) ==2:
             # this assumes that the shifts are independent variables in x and y
             # Hence, the shifts can be written in the following form: delta(x,y,t) = delta_1(x,t)delta_2(y,t).
@@ -333,27 +1108,22 @@ class transforms:
             shiftx_pos = shifts[0,...]
             shifty_pos = shifts[1,...]
 
-
-            shiftx_pos_mat_list = self.compute_shift_matrix(shiftx_pos, Lx, dx, Nx, order = interp_order[0])
-            shifty_pos_mat_list = self.compute_shift_matrix(shifty_pos, Ly, dy, Ny, order = interp_order[0])
-
-            # kron for each time slice
-            for shiftx, shifty in zip(shiftx_pos_mat_list, shifty_pos_mat_list):
-                shift_pos_mat_list.append(sparse.kron(sparse.kron(shiftx, shifty), sparse.eye(Nvar)))
+            stencils_pos = [self.compute_shift_stencil(shiftx_pos, Lx, dx, Nx, order = interp_order[0]),
+                            self.compute_shift_stencil(shifty_pos, Ly, dy, Ny, order = interp_order[0])]
 
             ### implement neg shift matrix ###
-
-
             shiftx_neg = -shiftx_pos
             shifty_neg = -shifty_pos
-            shiftx_neg_mat_list = self.compute_shift_matrix(shiftx_neg, Lx, dx, Nx, order = interp_order[1])
-            shifty_neg_mat_list = self.compute_shift_matrix(shifty_neg, Ly, dy, Ny, order = interp_order[1])
+            stencils_neg = [self.compute_shift_stencil(shiftx_neg, Lx, dx, Nx, order = interp_order[1]),
+                            self.compute_shift_stencil(shifty_neg, Ly, dy, Ny, order = interp_order[1])]
 
-            # kron for each time slice
-            for shiftx, shifty in zip(shiftx_neg_mat_list, shifty_neg_mat_list):
-                shift_neg_mat_list.append(sparse.kron(sparse.kron(shiftx, shifty), sparse.eye(Nvar)))
+            # the stencils are combined for each time slice, which replaces the kron product of the shift matrices
+            return BatchedOperator.from_stencils([Nx, Ny, Nvar], stencils_pos), \
+                   BatchedOperator.from_stencils([Nx, Ny, Nvar], stencils_neg)
 
         else:
+            shift_pos_mat_list = []
+            shift_neg_mat_list = []
 
             shift_pos_list = self.compute_general_shift_matrix(shifts, domain_size, [dx,dy], Ngrid)
             for shiftmat in shift_pos_list:
@@ -364,12 +1134,7 @@ class transforms:
             for shiftmat in shift_neg_list:
                 shift_neg_mat_list.append(sparse.kron(shiftmat, sparse.eye(Nvar)))
 
-
-        #
-        # shiftx_pos = shifts[0,...]
-        # shifty_pos = shifts[1,...]
-
-        return shift_pos_mat_list, shift_neg_mat_list
+        return BatchedOperator.from_sparse_list(shift_pos_mat_list), BatchedOperator.from_sparse_list(shift_neg_mat_list)
 
     def init_shifts_1D(self, dx, Lx, Nx, shifts, Nvar=1):
 
@@ -386,200 +1151,234 @@ class transforms:
         print("Forward T^k:     O(h^%d)"%interp_order[0])
         print("Backward T^(-k): O(h^%d)" % interp_order[1])
         ### implement pos shift matrix ###
-        shift_pos_mat_list = []
         shiftx_pos = shifts[:]
-        shiftx_pos_mat_list = self.compute_shift_matrix(shiftx_pos, Lx, dx, Nx, order = interp_order[0])
-        # kron for each time slice
-        for shiftx in shiftx_pos_mat_list:
-            shift_pos_mat_list.append(sparse.kron(shiftx, sparse.eye(Nvar)))
+        stencil_pos = self.compute_shift_stencil(shiftx_pos, Lx, dx, Nx, order = interp_order[0])
 
         ### implement neg shift matrix ###
-        shift_neg_mat_list = []
         shiftx_neg = -shiftx_pos
-        shiftx_neg_mat_list = self.compute_shift_matrix(shiftx_neg, Lx, dx, Nx, order = interp_order[1])
+        stencil_neg = self.compute_shift_stencil(shiftx_neg, Lx, dx, Nx, order = interp_order[1])
 
-        # kron for each time slice
-        for shiftx in shiftx_neg_mat_list:
-            shift_neg_mat_list.append(sparse.kron(shiftx, sparse.eye(Nvar)))
+        return BatchedOperator.from_stencils([Nx, Nvar], [stencil_pos]), \
+               BatchedOperator.from_stencils([Nx, Nvar], [stencil_neg])
+
+    def init_shift_stencils(self, dX, domain_size, Ngrid, shifts):
+        """
+        Matrix free alternative to init_shifts_1D and init_shifts_2D:
+        Only the base offsets and the Lagrange weights of every time step are stored
+        for each axis and for the forward and backward transform.
+        """
+        if not isinstance(self.interp_order, list):
+            interp_order = [self.interp_order, self.interp_order]
+        else:
+            interp_order = self.interp_order
+
+        print("Setting up the matrix free shift stencils, with interpolation order:")
+        print("Forward T^k:     O(h^%d)"%interp_order[0])
+        print("Backward T^(-k): O(h^%d)" % interp_order[1])
+
+        shifts = np.reshape(shifts, [self.dim, -1])
+        assert (np.ndim(shifts) == 2), "matrix free shifts are only implemented for separable shifts delta(x,y,t)=delta_1(x,t)delta_2(y,t)"
+        stencils_pos = [self.compute_shift_stencil(shifts[d], domain_size[d], dX[d], Ngrid[d], order=interp_order[0])
+                        for d in range(self.dim)]
+        stencils_neg = [self.compute_shift_stencil(-shifts[d], domain_size[d], dX[d], Ngrid[d], order=interp_order[1])
+                        for d in range(self.dim)]
+        grid_shape = self.data_shape[:-1]
+
+        return StencilOperator(grid_shape, stencils_pos), StencilOperator(grid_shape, stencils_neg)
+
+    def init_shifts_spectral(self, dX, domain_size, Ngrid, shifts):
+        """
+        Spectral alternative to init_shifts_1D and init_shifts_2D for periodic domains:
+        The phase tables exp(i k s(t)) of the forward and backward transform are computed
+        for every axis. No interpolation matrices are needed.
+        """
+        print("Setting up the spectral shift operators")
+
+        shifts = np.reshape(shifts, [self.dim, -1])
+        assert (np.ndim(shifts) == 2), "spectral shifts are only implemented for separable shifts delta(x,y,t)=delta_1(x,t)delta_2(y,t)"
+        phases = []
+        for d in range(self.dim):
+            # the last axis is transformed with a real fft
+            if d == self.dim - 1:
+                k = 2 * np.pi * np.fft.rfftfreq(Ngrid[d], d=dX[d])
+            else:
+                k = 2 * np.pi * np.fft.fftfreq(Ngrid[d], d=dX[d])
+            phase = np.exp(1j * np.outer(k, shifts[d]))
+            if Ngrid[d] % 2 == 0:
+                # the Nyquist mode cannot be shifted such that the field stays real. It is left unshifted
+                # in both directions, which keeps T^(-k) o T^k the identity
+                phase[Ngrid[d]//2, :] = 1
+            phases.append(phase)
+        grid_shape = self.data_shape[:-1]
+
+        return SpectralOperator(grid_shape, phases), SpectralOperator(grid_shape, [np.conj(phase) for phase in phases])
+
+    def init_rotate(self, use_scipy_transform=False):
+        """
+        Selects the implementation of the rotation and sets up the rotation operators
+        """
+        if use_scipy_transform:
+            self.rotate = self.rotate_scipy
+            self.rotations_pos = self.rotations
+            self.rotations_neg = -self.rotations
+        else: # own implementation for rotations: is much faster then ndimage
+            self.rotate = self.rotate1
+            self.rotations_pos, self.rotations_neg = self.init_rotations()
 
-        return shift_pos_mat_list, shift_neg_mat_list
-    
     def init_rotations(self):
-        ### implement pos shift matrix ###
-        rotation_pos_mat_list = []
-                
-        Nx, Ny = self.Ngrid
-        Lx, Ly = self.domain_size
-        dx, dy = self.dx
-        
+        if not isinstance(self.interp_order, list):
+            interp_order = [self.interp_order, self.interp_order]
+        else:
+            interp_order = self.interp_order
+        # the spectral interpolation is only available for shifts
+        interp_order = [order if order in [1, 3, 5] else 3 for order in interp_order]
+
+        print("Setting up the rotation operators, with interpolation order:")
+        print("Forward T^k:     O(h^%d)"%interp_order[0])
+        print("Backward T^(-k): O(h^%d)" % interp_order[1])
+
         rotations_pos = self.rotations
         rot_center    = self.rotation_center
         rotations_neg = - rotations_pos
-        
-        rotation_pos_mat_list=self.compute_rotation_matrix(rotations_pos, rot_center, \
-                                                         self.domain_size, self.dx, self.Ngrid)
-        
-        rotation_neg_mat_list=self.compute_rotation_matrix(rotations_neg, rot_center, \
-                                                         self.domain_size, self.dx, self.Ngrid)
-        
-        return rotation_pos_mat_list, rotation_neg_mat_list
-        
+
+        rotation_pos_operator = self.compute_rotation_operator(rotations_pos, rot_center, self.dx, self.Ngrid,
+                                                               Nvar=self.Nvar, order=interp_order[0])
+
+        rotation_neg_operator = self.compute_rotation_operator(rotations_neg, rot_center, self.dx, self.Ngrid,
+                                                               Nvar=self.Nvar, order=interp_order[1])
+
+        return rotation_pos_operator, rotation_neg_operator
+
+    def compute_rotation_operator(self, rotations, center, spacing, Ngrid, Nvar=1, order=3):
+        """
+        Computes the batched interpolation operator of the rotations at all time steps.
+
+        :param rotations: np.array of rotation angles omega(t) of size [#Snapshots]
+        :param center: (x_0, y_0) position of the center of rotation.
+                       If None, the center of the grid is used (like ndimage.rotate).
+        :param spacing: lattice spacings (dx, dy)
+        :param Ngrid: number of grid points (Nx, Ny)
+        :param Nvar: number of variables, every variable is rotated separately
+        :param order: order of the Lagrange interpolation in each direction
+        :return: BatchedOperator which rotates the field around the center
+                 q(x, t) -> q(x_0 + R(-omega(t))(x - x_0), t)
+                 where R is the rotation matrix. Since the data only exists on discrete points, we interpolate.
+                 Points outside of the domain are assumed to be zero.
+        """
+        Nx, Ny = Ngrid
+        X, Y = meshgrid(np.arange(Nx, dtype=float), np.arange(Ny, dtype=float), indexing="ij")
+        points = np.stack([np.broadcast_to(np.reshape(grid, [1, -1]), [np.size(rotations), Nx * Ny])
+                           for grid in [X, Y]])
+        # rotated grid points in units of the lattice spacings, size 2 x Ntime x Nx*Ny
+        grid_points = rotate_points(points, rotations, center, spacing, Ngrid)
+
+        # no periodicity: stencil points outside of the domain do not contribute
+        return map_stencil_operator(grid_points, Ngrid, Nvar, order, periodic=False)
+
+    def coordinate_maps(self, inverse=False):
+        """
+        Returns the coordinate maps phi_1, ..., phi_n of the transformation (see compute_map_operator):
+            (T q)(x, t) = q(phi_n(...phi_1(x, t)...), t)
+        or the maps of T^(-1) if inverse is true. The maps act on points in units of the lattice spacings.
+        """
+        assert not self.use_scipy_transform, "the scipy transforms have no coordinate maps"
+        sign = -1 if inverse else 1
+        maps = {}
+        if self.shifts is not None:
+            maps["shift"] = shift_map(sign * self.shifts, self.domain_size, self.dx)
+        if getattr(self, "rotations", None) is not None:
+            maps["rotation"] = rotation_map(sign * self.rotations, self.rotation_center, self.dx, self.Ngrid)
+        if self.trafo_type == "shift":
+            return [maps["shift"]]
+        elif self.trafo_type == "rotation":
+            return [maps["rotation"]]
+        elif self.trafo_type == "shiftRot":
+            # T q = shift(rotate(q)) and T^(-1) q = rotate^(-1)(shift^(-1)(q))
+            return [maps["rotation"], maps["shift"]] if inverse else [maps["shift"], maps["rotation"]]
+        elif self.trafo_type == "identity":
+            return []
+        else:
+            assert False, "transformation type %s has no coordinate maps" % self.trafo_type
+
+    def init_fused_operators(self, trafo_list):
+        """
+        Sets up the operators (T, T^(-1)) of the composition T = T_1 o ... o T_n of the transformations in
+        trafo_list, which are applied in a single pass (see compute_map_operator)
+        """
+        if not isinstance(self.interp_order, list):
+            interp_order = [self.interp_order, self.interp_order]
+        else:
+            interp_order = self.interp_order
+        # the spectral interpolation is only available for shifts
+        interp_order = [order if order in [1, 3, 5] else 3 for order in interp_order]
+
+        print("Setting up the fused operators, with interpolation order:")
+        print("Forward T^k:     O(h^%d)"%interp_order[0])
+        print("Backward T^(-k): O(h^%d)" % interp_order[1])
+
+        Ngrid = list(self.Ngrid[:self.dim])
+        Nvar = int(np.prod(self.data_shape[:3]) // np.prod(Ngrid))
+        maps_pos = [phi for trafo in trafo_list for phi in trafo.coordinate_maps()]
+        maps_neg = [phi for trafo in trafo_list[::-1] for phi in trafo.coordinate_maps(inverse=True)]
+        operators = [compute_map_operator(maps, Ngrid, self.Ntime, Nvar, order)
+                     for maps, order in zip([maps_pos, maps_neg], interp_order)]
+
+        return tuple(operator.astype(self.dtype) for operator in operators)
+
+    def compute_shift_stencil(self, shift_list, domain_length, spacing, Npoints, order=3):
+        """
+        Computes the interpolation stencil of the shift for every time step.
+
+        :return: base (Ntime,) integer index idx_0 next to the shifted point,
+                 offsets (order+1,) of the stencil points relative to idx_0,
+                 weights (Ntime, order+1) Lagrange coefficients of the stencil points
+        """
+        return lagrange_stencil(np.asarray(shift_list), domain_length, spacing, order=order)
+
     def compute_shift_matrix(self,shift_list, domain_length, spacing, Npoints, order=3):
-        from numpy import floor
-        
+
         Mat = []
-        domain_size = self.domain_size
-        for it,shift in enumerate(shift_list):
-            
-            # we assume periodicity here
-            shift = np.mod(shift, domain_size[0])  # if periodicity is assumed
-
-            ''' interpolation scheme        lagrange_idx(x)= (x-x_{idx-1})/(x_idx - x_0)+
-            -1      0   x    1       2                    ...+(x-x_{idx+2})/(x_idx - x_{idx+2})
-             +      +   x    +       +
-           idx_m1  idx_0    idx_1   idx_2
-          =idx_0-1        =idx_0+1
-           '''
-           
-            # shift is close to some discrete index:
-            idx_0 = floor(shift/spacing)
+        base, offsets, weights = self.compute_shift_stencil(shift_list, domain_length, spacing, Npoints, order=order)
+        for idx_0, lagrange_coefs in zip(base, weights):
             # save all neighbours
-            if order == 5:
-                idx_list = np.asarray([idx_0 - 2,idx_0 - 1, idx_0, idx_0 + 1, idx_0 + 2, idx_0 + 3], dtype=np.int32)
-            elif order == 3:
-                idx_list = np.asarray([idx_0 - 1, idx_0, idx_0 + 1, idx_0 + 2], dtype=np.int32)
-            elif order == 1:
-                idx_list = np.asarray([ idx_0, idx_0 + 1], dtype=np.int32)
-            else:
-                assert(False), "please choose correct order for interpolation"
-
-            idx_list = np.asarray([np.mod(idx, Npoints) for idx in idx_list])  # assumes periodicity
+            idx_list = np.mod(idx_0 + offsets, Npoints)  # assumes periodicity
             # subdiagonals needed if point is on other side of domain
             idx_subdiags_list = idx_list - Npoints
-            # compute the distance to the index
-            delta_idx = shift/spacing - idx_0
-            # compute the 4 langrage basis elements
-            if order == 5:
-                lagrange_coefs = [lagrange(delta_idx, [-2,-1, 0, 1, 2, 3], j) for j in range(6)]
-            elif order == 3:
-                lagrange_coefs = [lagrange(delta_idx, [-1,0,1,2], j) for j in range(4)]
-            elif order == 1:
-                lagrange_coefs = [lagrange(delta_idx, [0, 1], j) for j in range(2)]
-            else:
-                assert (False), "please choose correct order for interpolation"
             # for the subdiagonals as well
-            lagrange_coefs = lagrange_coefs + lagrange_coefs
-            
+            lagrange_coefs = list(lagrange_coefs) + list(lagrange_coefs)
+
             # band diagonals for the shift matrix
-            offsets = np.concatenate([idx_list,idx_subdiags_list])
+            offsets_diag = np.concatenate([idx_list,idx_subdiags_list])
             diagonals = [np.ones(Npoints+1)*Lj  for Lj in lagrange_coefs]
 
-            Mat.append(sparse.diags(diagonals,offsets,shape=[Npoints,Npoints]))
-        
+            Mat.append(sparse.diags(diagonals,offsets_diag,shape=[Npoints,Npoints]))
+
         return Mat
 
 
     def compute_general_shift_matrix(self, shifts, domain_size, spacings, Ngrid):
         """
 
-        :param shifts: shift(x_i,t_j) assumes an array of size i=0,...,Nx -1 ; j=0,...,Nt
-        :param domain_length:
+        :param shifts: shift(x_i,y_i,t_j) assumes an array of size 2 x Nx*Ny x Nt,
+                       where the grid points are ordered lexicographically i = ix*Ny + iy
+        :param domain_size:
         :param spacings:
-        :param Npoints:
-        :return:
+        :param Ngrid:
+        :return: list of sparse shift matrices in CSR format, one for each time step
         """
-
-        ''' interpolation scheme        lagrange_idx(x)= (x-x_{idx-1})/(x_idx - x_0)+
-        -1      0   x    1       2                    ...+(x-x_{idx+2})/(x_idx - x_{idx+2})
-         +      +   x    +       +
-       idx_m1  idx_0    idx_1   idx_2
-      =idx_0-1        =idx_0+1
-       '''
-        from joblib import Parallel, delayed # function has to be parallelized since it take a long time to set up a general transformation matrix
-
         Nt = np.size(shifts, -1)
         Nx, Ny = Ngrid
-        [Ix, Iy] = meshgrid2D(np.arange(0, Nx), np.arange(0, Ny))
-        Ix, Iy = Ix.flatten(), Iy.flatten()
 
-        def my_parallel_fun(it):
-            col,row,val = compute_general_shift_matrix_numba(shifts[..., it], np.asarray(domain_size), np.asarray(spacings),
-                                               np.asarray(Ngrid), Ix, Iy)
-            return sparse.coo_matrix((val, (row, col)), shape=(Nx * Ny, Nx * Ny)).tocsc()
+        # interpolation stencils of all grid points and time steps
+        base_x, offsets, weights_x = lagrange_stencil(shifts[0], domain_size[0], spacings[0], order=3)
+        base_y, offsets, weights_y = lagrange_stencil(shifts[1], domain_size[1], spacings[1], order=3)
+        base = np.stack([base_x, base_y])
 
-        Tmat_time_list = Parallel(n_jobs=-2)(delayed(my_parallel_fun)(it) for it in range(Nt))
-        # for it in range(Nt):
-        #     Tmat_time_list.append(sparse.coo_matrix((val, (row, col)), shape=(Nx * Ny, Nx * Ny)))
+        col, val = compute_general_shift_matrix_numba(base, offsets, weights_x, weights_y, np.asarray(Ngrid))
+        # every row has the same number of nonzero elements, so the CSR format is set up directly
+        Nnonzero = np.size(col, -1)
+        indptr = np.arange(0, Nx * Ny * Nnonzero + 1, Nnonzero)
+        Tmat_time_list = [sparse.csr_matrix((val[it].reshape(-1), col[it].reshape(-1), indptr), shape=(Nx * Ny, Nx * Ny))
+                          for it in range(Nt)]
 
         return Tmat_time_list
-
-
-
-
-    # def compute_rotation_matrix(self, rotations, center, domain_length, spacing, Npoints):
-    #     """
-
-    #     Parameters
-    #     ----------
-    #     rotations : np.array of rotations size [#Snapshots]
-    #                 This array should include the angle to the reference position
-    #                 at every time point
-    #     center : np.array of size 2
-    #              (x,y) position of the center of rotation
-    #     domain_length : np.array of size 2
-                
-    #     spacing : np.array of size 2
-    #             lattice spacing
-    #     Npoints : np.array Number of Gridpoints in x and y direction
-            
-
-    #     Returns
-    #     -------
-    #     Mat : Array of sparse matrix which rotate the field arround a center
-    #          q(x',y', t) = M(omega(t))@ q(x,y,t) where q is a snapshot reshaped to a columnvector
-    #          here (x')  = (cos(omega)* x - sin(omega)* y )
-    #               (y')  = (sin(omega)* x + cos(omega)* y )
-    #         Since the data only exists on discrete time points, we have to interpolate!
-    #         The interpolation stencil ist defined in M(omega(t))
-    #     """
-    #     from numpy import floor
-        
-    #     Mat = []
-    #     for shift in rotations:
-            
-    #         # we assume periodicity here
-    #         if shift > domain_length:
-    #             shift = shift - domain_length
-    #         elif shift < 0:
-    #             shift = shift + domain_length
-        
-    #         ''' interpolation scheme        lagrange_idx(x)= (x-x_{idx-1})/(x_idx - x_0)+
-    #         -1      0   x    1       2                    ...+(x-x_{idx+2})/(x_idx - x_{idx+2})
-    #          +      +   x    +       +
-    #        idx_m1  idx_0    idx_1   idx_2
-    #       =idx_0-1        =idx_0+1
-    #        '''
-           
-    #         # shift is close to some discrete index:
-    #         idx_0 = floor(shift/spacing)
-    #         # save all neighbours
-    #         idx_list = np.asarray([idx_0-1, idx_0, idx_0+1, idx_0+2],dtype=np.int32)
-            
-    #         if idx_list[0] < 0 : idx_list[0] += Npoints 
-    #         if idx_list[3] > Npoints-1 : idx_list[3] -= Npoints
-    #         # subdiagonals needed if point is on other side of domain
-    #         idx_subdiags_list = idx_list - Npoints
-    #         # compute the distance to the index
-    #         delta_idx = shift/spacing - idx_0
-    #         # compute the 4 langrage basis elements
-    #         lagrange_coefs = [lagrange(delta_idx, [-1,0,1,2], j) for j in range(4)]
-    #         # for the subdiagonals as well
-    #         lagrange_coefs = lagrange_coefs +lagrange_coefs
-            
-    #         # band diagonals for the shift matrix
-    #         offsets = np.concatenate([idx_list,idx_subdiags_list])
-    #         diagonals = [np.ones(Npoints)*Lj  for Lj in lagrange_coefs]
-
-   #         Mat.append(sparse.diags(diagonals,offsets,shape=[Npoints,Npoints]))
-        
-   #     return Mat